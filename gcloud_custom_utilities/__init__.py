@@ -1,4 +1,4 @@
-from bigquery_utility import BigqueryUtility, read_string_from_file, convert_file_to_string, get_schema_from_dataframe, get_schema_from_json
+from bigquery_utility import BigqueryUtility, read_string_from_file, convert_file_to_string, convert_file_to_chunks, get_schema_from_dataframe, get_schema_from_json, PollingPolicy, QueryResultCache, ShardCatalog, StreamingInserter, JobScheduler
 from gcs_utility import GcsUtility
 from adwords_utility import AdwordsUtility, AdwordsReportCleaner
 from gmail_utility import GmailUtility, generate_email_search_query, convert_list_to_html
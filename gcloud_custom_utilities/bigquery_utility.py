@@ -4,14 +4,31 @@ import pandas as pd
 import unicodecsv as csv
 from io import BytesIO
 import json
-from time import sleep
+from time import sleep, time
 import os
-from itertools import chain
+import random
+import hashlib
+import cPickle as pickle
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from itertools import chain, islice
+from collections import OrderedDict, Iterator, deque
+import zlib
+import threading
+import Queue
+import inspect
+import gzip
+import shutil
+import tempfile
+from copy import deepcopy
 
 from oauth2client.client import GoogleCredentials, ApplicationDefaultCredentialsError, flow_from_clientsecrets, UnknownClientSecretsFlowError
 from googleapiclient.discovery import build
 from googleapiclient.errors import Error, HttpError
-from googleapiclient.http import MediaInMemoryUpload
+from googleapiclient.http import MediaInMemoryUpload, MediaFileUpload
+from httplib2 import HttpLib2Error
+
+from misc_utility import ThreadLocalHttp, get_stream_media, execute_resumable
 pd.set_option('expand_frame_repr', False)
 
 
@@ -21,11 +38,30 @@ def read_string_from_file(read_path):
     return read_string
 
 
-def convert_file_to_string(f, source_format='csv'):
+def convert_file_to_chunks(f, source_format='csv', chunk_size=1024 * 1024, gzip_output=False):
+    """Generator version of convert_file_to_string, yielding the output in chunks of about chunk_size bytes.
+
+    Also accepts an iterator of lists (csv) or of json objects (json) so rows never need to be held in memory.
+    With gzip_output the chunks are gzip compressed on the fly. The chunks can be passed straight to
+    BigqueryUtility.load_from_file, which accepts gzip compressed CSV and JSON."""
     assert source_format.lower() in ('csv', 'json')
+    source_format = source_format.lower()
 
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzip_output else None
     io_output = BytesIO()
 
+    def _flush_output(is_final=False):
+        output_string = io_output.getvalue()
+        io_output.seek(0)
+        io_output.truncate()
+
+        if compressor is not None:
+            output_string = compressor.compress(output_string)
+            if is_final:
+                output_string += compressor.flush()
+
+        return output_string
+
     if source_format == 'csv':
         string_writer = csv.writer(io_output, lineterminator='\n')
 
@@ -33,18 +69,35 @@ def convert_file_to_string(f, source_format='csv'):
         if isinstance(f, str):
             assert os.path.exists(f)
 
-            with open(f, 'rb') as read_file:
-                string_writer.writerows(csv.reader(read_file))
+            read_file = open(f, 'rb')
+            row_iterator = csv.reader(read_file)
+
+        # also accepts list of lists, or an iterator of lists
+        elif isinstance(f, (list, tuple)) and any(isinstance(el, list) for el in f):
+            read_file = None
+            row_iterator = f
 
-        # also accepts list of lists
-        elif any(isinstance(el, list) for el in f):
-            string_writer.writerows(f)
+        elif isinstance(f, Iterator):
+            read_file = None
+            row_iterator = f
 
         else:
-            raise TypeError('Only file path or list of lists accepted')
+            raise TypeError('Only file path, list of lists or iterator of lists accepted')
+
+        try:
+            for row in row_iterator:
+                string_writer.writerow(row)
+
+                if io_output.tell() >= chunk_size:
+                    output_string = _flush_output()
+                    if output_string:
+                        yield output_string
+        finally:
+            if read_file is not None:
+                read_file.close()
 
     elif source_format == 'json':
-        # can be loaded from file path or string in a json structure
+        # can be loaded from file path or string in a json structure, or an iterable of json objects
         if isinstance(f, str):
             if os.path.exists(f):
                 with open(f, 'rb') as read_file:
@@ -53,22 +106,28 @@ def convert_file_to_string(f, source_format='csv'):
                 json_obj = json.loads(f)
 
         else:
-            try:
-                json.dumps(f)
-                json_obj = f
-            except TypeError as e:
-                raise e
+            json_obj = f
 
+        # newline delimited, without a trailing newline after the last object
         for index, obj in enumerate(json_obj):
-            if index < len(json_obj) - 1:
-                io_output.write(json.dumps(obj) + '\n')
-            else:
-                io_output.write(json.dumps(obj))
+            if index > 0:
+                io_output.write('\n')
+            io_output.write(json.dumps(obj))
 
-    return_string = io_output.getvalue()
+            if io_output.tell() >= chunk_size:
+                output_string = _flush_output()
+                if output_string:
+                    yield output_string
+
+    output_string = _flush_output(is_final=True)
     io_output.close()
 
-    return return_string
+    if output_string:
+        yield output_string
+
+
+def convert_file_to_string(f, source_format='csv'):
+    return b''.join(convert_file_to_chunks(f, source_format))
 
 
 def get_schema_from_dataframe(input_df):
@@ -91,6 +150,91 @@ def get_schema_from_dataframe(input_df):
     return dtype_df.to_dict('records')
 
 
+def _serialize_dataframe_chunk(args):
+    # module level so it can be pickled for multiprocessing, each chunk becomes its own gzip member
+    chunk_df, source_format = args
+
+    if source_format == 'CSV':
+        chunk_string = chunk_df.to_csv(index=False, header=False, encoding='utf-8')
+    else:
+        chunk_string = chunk_df.to_json(orient='records', lines=True, date_format='iso') + '\n'
+
+    if isinstance(chunk_string, unicode):
+        chunk_string = chunk_string.encode('utf-8')
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(chunk_string) + compressor.flush()
+
+
+def _iterate_dataframe_chunks(input_df, source_format, chunk_rows, processes):
+    # only a few chunks are in flight at once, so the full text of the dataframe is never held in memory
+    pool = Pool(processes)
+    try:
+        pending_chunks = deque()
+
+        for chunk_start in range(0, len(input_df), chunk_rows):
+            pending_chunks.append(
+                pool.apply_async(_serialize_dataframe_chunk, ((input_df.iloc[chunk_start:chunk_start + chunk_rows], source_format),))
+            )
+
+            if len(pending_chunks) >= 2 * processes:
+                yield pending_chunks.popleft().get()
+
+        while len(pending_chunks) > 0:
+            yield pending_chunks.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def _get_dataframe_from_columns(column_values, schema_fields):
+    # builds each column as a typed array straight from the api's string values, without a text round trip
+    return_df = pd.DataFrame(index=pd.RangeIndex(len(column_values[0]) if column_values else 0))
+
+    for values, field in zip(column_values, schema_fields):
+        values = pd.Series(values, dtype=object)
+
+        if field.get('mode') == 'REPEATED' or field['type'] in ('RECORD', 'STRUCT'):
+            column = values
+
+        elif field['type'] in ('INTEGER', 'INT64'):
+            # integer columns with nulls are upcast to float64, same as read_csv
+            column = pd.to_numeric(values)
+
+        elif field['type'] in ('FLOAT', 'FLOAT64'):
+            # float() also parses the NaN, Infinity and -Infinity strings returned for non-finite values
+            column = values.astype(float)
+
+        elif field['type'] in ('BOOLEAN', 'BOOL'):
+            if values.isnull().any():
+                column = values.map({'true': True, 'false': False})
+            else:
+                column = (values == 'true').astype(bool)
+
+        elif field['type'] == 'TIMESTAMP':
+            if values.str.endswith(' UTC').any():
+                # table exports write timestamps as YYYY-MM-DD HH:MM:SS[.ffffff] UTC
+                column = pd.to_datetime(values.str[:-4])
+            else:
+                # timestamps are returned as epoch seconds in scientific notation
+                column = pd.to_datetime(pd.to_numeric(values) * 1e6, unit='us')
+
+        else:
+            column = values
+
+        return_df[field['name']] = column
+
+    return return_df
+
+
+def _get_shard_dates(table_ids):
+    # parses the YYYYMMDD suffix of every table id in one pass, tables without a date suffix are dropped
+    table_ids = pd.Series(table_ids, dtype=object)
+    shard_dates = pd.to_datetime(table_ids.str[-8:], format='%Y%m%d', errors='coerce')
+    shard_dates.index = table_ids.values
+
+    return shard_dates.dropna()
+
+
 class get_schema_from_json:
     def __init__(self):
         self.dtype_conversion = {
@@ -104,18 +248,41 @@ class get_schema_from_json:
         }
 
     def _get_dict_structure(self, d):
+        return self._get_structure_and_key(d)[0]
+
+    def _get_structure_and_key(self, d):
+        # builds the structure along with a hashable key of its shape in the same walk
         out = {}
+        shape_items = []
+        dtype_conversion = self.dtype_conversion
+
         for k, v in d.iteritems():
-            if isinstance(v, dict):
-                out[k] = self._get_dict_structure(v)
+            # scalars are by far the most common values, so they're checked first with a single lookup
+            dtype = dtype_conversion.get(type(v).__name__)
+
+            if dtype is not None:
+                out[k] = shape_key = dtype
+
+            elif v is None:
+                continue
+
+            elif isinstance(v, dict):
+                out[k], shape_key = self._get_structure_and_key(v)
+
             elif isinstance(v, list):
                 out[k] = []
                 collapsed_dict = None
+                item_shape_keys = set()
 
                 # if mode is repeated, all the distinct attributes of every record should be included in the schema
                 for item in v:
                     if isinstance(item, dict):
-                        expanded_item = self._get_dict_structure(item)
+                        expanded_item, item_shape_key = self._get_structure_and_key(item)
+
+                        # records with an identical shape are only merged once
+                        if item_shape_key in item_shape_keys:
+                            continue
+                        item_shape_keys.add(item_shape_key)
 
                         if collapsed_dict is None:
                             collapsed_dict = expanded_item.copy()
@@ -125,24 +292,44 @@ class get_schema_from_json:
                         out[k].append(item)
 
                 out[k].append(collapsed_dict)
+                shape_key = frozenset(item_shape_keys)
 
             else:
-                if v is not None:
-                    out[k] = self.dtype_conversion[type(v).__name__]
-        return out
+                raise KeyError(type(v).__name__)
+
+            shape_items.append((k, shape_key))
+
+        return out, frozenset(shape_items)
 
     def merge_dicts(self, original_dict, new_dict):
+        # returns whether any new field was added to original_dict
+        is_changed = False
+
         for k, v in new_dict.iteritems():
             if k in original_dict:
                 if isinstance(original_dict[k], dict) and isinstance(v, dict):
-                    self.merge_dicts(original_dict[k], v)
+                    is_changed = self.merge_dicts(original_dict[k], v) or is_changed
 
                 elif isinstance(v, list):
+                    # only records are merged, and repeated records are already collapsed into one per list
+                    original_records = [item for item in original_dict[k] if isinstance(item, dict)]
+
                     for item in v:
-                        for original_item in original_dict[k]:
-                            self.merge_dicts(original_item, item)
+                        if not isinstance(item, dict):
+                            continue
+
+                        if len(original_records) == 0:
+                            original_records = [item]
+                            original_dict[k] = [x for x in original_dict[k] if x is not None] + original_records
+                            is_changed = True
+                        else:
+                            for original_item in original_records:
+                                is_changed = self.merge_dicts(original_item, item) or is_changed
             else:
                 original_dict[k] = v
+                is_changed = True
+
+        return is_changed
 
     def structure_to_schema(self, structure):
         schema_list = []
@@ -178,17 +365,89 @@ class get_schema_from_json:
         return schema_list
 
     def merge_list(self, record_list, return_type='schema'):
+        return self.merge_iterable(record_list, return_type)
+
+    def merge_iterable(self, records, return_type='schema', sample_size=None, stable_after=None):
+        """Infers the schema in one pass over an iterable of records or NDJSON lines, holding only the merged structure.
+
+        sample_size reservoir samples that many records (raw lines are sampled before parsing) and only merges those.
+        stable_after stops early once that many consecutive records have added no new fields."""
         assert return_type in ('schema', 'structure')
 
+        if sample_size is not None:
+            records = _reservoir_sample(records, sample_size)
+
         merged_dict = None
+        stable_count = 0
+        merged_shape_keys = set()
+
+        for record in records:
+            if isinstance(record, basestring):
+                if not record.strip():
+                    continue
+                record = json.loads(record)
 
-        for record in record_list:
-            record_structure = self._get_dict_structure(record)
+            record_structure, shape_key = self._get_structure_and_key(record)
 
             if merged_dict is None:
                 merged_dict = record_structure.copy()
+                is_changed = True
+
+            # a shape that was already merged can't add any fields
+            elif shape_key in merged_shape_keys:
+                is_changed = False
+
             else:
-                self.merge_dicts(merged_dict, record_structure)
+                is_changed = self.merge_dicts(merged_dict, record_structure)
+
+            # bounded so records with endlessly varying shapes don't grow the set without limit
+            if len(merged_shape_keys) >= 10000:
+                merged_shape_keys.clear()
+            merged_shape_keys.add(shape_key)
+
+            stable_count = 0 if is_changed else stable_count + 1
+
+            if stable_after is not None and stable_count >= stable_after:
+                break
+
+        if merged_dict is None:
+            merged_dict = {}
+
+        if return_type == 'schema':
+            return self.structure_to_schema(merged_dict)
+        else:
+            return merged_dict
+
+    def merge_file(self, file_path, return_type='schema', processes=1, sample_size=None, stable_after=None):
+        """Infers the schema of an NDJSON file without loading it into memory.
+
+        With processes > 1 the file is split into that many byte ranges on line boundaries, each range is
+        merged in its own process and the partial structures are merged at the end. sample_size and
+        stable_after apply to each range."""
+        assert return_type in ('schema', 'structure')
+
+        file_size = os.path.getsize(file_path)
+        processes = max(1, min(processes, file_size))
+        chunk_size = file_size // processes + 1
+
+        chunk_args = [
+            (file_path, chunk_start, min(chunk_start + chunk_size, file_size), sample_size, stable_after)
+            for chunk_start in range(0, file_size, chunk_size)
+        ]
+
+        if len(chunk_args) > 1:
+            pool = Pool(len(chunk_args))
+            try:
+                structure_list = pool.map(_get_file_chunk_structure, chunk_args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            structure_list = [_get_file_chunk_structure(chunk_arg) for chunk_arg in chunk_args]
+
+        merged_dict = {}
+        for structure in structure_list:
+            self.merge_dicts(merged_dict, structure)
 
         if return_type == 'schema':
             return self.structure_to_schema(merged_dict)
@@ -196,13 +455,615 @@ class get_schema_from_json:
             return merged_dict
 
 
+def _reservoir_sample(iterable, sample_size):
+    sample_list = []
+    for index, item in enumerate(iterable):
+        if index < sample_size:
+            sample_list.append(item)
+        else:
+            replace_index = random.randint(0, index)
+            if replace_index < sample_size:
+                sample_list[replace_index] = item
+
+    return sample_list
+
+
+def _iterate_file_range(file_path, range_start, range_end):
+    # yields the lines starting within [range_start, range_end), a line split by range_start belongs to the previous range
+    with open(file_path, 'rb') as read_file:
+        if range_start > 0:
+            read_file.seek(range_start - 1)
+            read_file.readline()
+
+        while read_file.tell() < range_end:
+            line = read_file.readline()
+            if not line:
+                break
+            yield line
+
+
+def _get_file_chunk_structure(args):
+    # module level so it can be pickled for multiprocessing
+    file_path, range_start, range_end, sample_size, stable_after = args
+
+    return get_schema_from_json().merge_iterable(
+        _iterate_file_range(file_path, range_start, range_end),
+        return_type='structure',
+        sample_size=sample_size,
+        stable_after=stable_after
+    )
+
+
+class PollingPolicy:
+    """Controls how often BigqueryUtility checks on running jobs.
+
+    Status checks start at initial_interval seconds and back off by multiplier up to max_interval,
+    each sleep reduced by a random fraction of up to jitter so that concurrent pollers spread out.
+    long_poll_ms is passed as timeoutMs to getQueryResults, letting the server hold the request
+    until the query completes instead of sleeping client side."""
+
+    def __init__(self, initial_interval=0.5, max_interval=10, multiplier=2, jitter=0.5, long_poll_ms=10000):
+        # a zero interval polls back to back, as sleep_time=0 always has
+        assert 0 <= initial_interval <= max_interval
+        assert multiplier >= 1 and 0 <= jitter < 1
+
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.long_poll_ms = long_poll_ms
+
+    def intervals(self):
+        interval = self.initial_interval
+        while True:
+            yield interval * (1 - self.jitter * random.random())
+            interval = min(interval * self.multiplier, self.max_interval)
+
+
+class QueryResultCache:
+    """On-disk cache of synchronous query results, passed to BigqueryUtility as result_cache.
+
+    Entries are keyed by the SQL and the lastModifiedTime of every table the query references,
+    so results are reused until a source table changes. Entries older than ttl seconds are dropped, and the
+    least recently used entries are evicted once the cache grows past max_size bytes.
+    Queries with non-deterministic functions such as NOW() should not be run through a cached utility."""
+
+    def __init__(self, cache_dir, max_size=1024 ** 3, ttl=24 * 60 * 60):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._ttl = ttl
+
+    def _get_path(self, key):
+        return os.path.join(self._cache_dir, '%s.pkl' % key)
+
+    def get(self, key):
+        cache_path = self._get_path(key)
+
+        try:
+            with open(cache_path, 'rb') as read_file:
+                created_at, value = pickle.load(read_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if time() - created_at > self._ttl:
+            self._remove(cache_path)
+            return None
+
+        # modified time tracks the last use for lru eviction, the entry may have been evicted since it was read
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+
+        return value
+
+    def set(self, key, value):
+        cache_path = self._get_path(key)
+        temp_path = '%s.%s.tmp' % (cache_path, uuid.uuid4().hex)
+
+        # written to a temp file first so concurrent readers never see a partial entry
+        with open(temp_path, 'wb') as write_file:
+            pickle.dump((time(), value), write_file, pickle.HIGHEST_PROTOCOL)
+
+        try:
+            os.rename(temp_path, cache_path)
+        except OSError:
+            # windows won't rename over an existing file
+            self._remove(cache_path)
+            os.rename(temp_path, cache_path)
+
+        self._evict()
+
+    def clear(self):
+        for file_name in os.listdir(self._cache_dir):
+            if file_name.endswith('.pkl'):
+                self._remove(os.path.join(self._cache_dir, file_name))
+
+    def _remove(self, cache_path):
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        entry_list = []
+        for file_name in os.listdir(self._cache_dir):
+            if file_name.endswith('.pkl'):
+                cache_path = os.path.join(self._cache_dir, file_name)
+                try:
+                    file_stat = os.stat(cache_path)
+                except OSError:
+                    continue
+                entry_list.append((file_stat.st_mtime, file_stat.st_size, cache_path))
+
+        total_size = sum(entry[1] for entry in entry_list)
+
+        for last_used, file_size, cache_path in sorted(entry_list):
+            if total_size <= self._max_size and time() - last_used <= self._ttl:
+                break
+
+            self._remove(cache_path)
+            total_size -= file_size
+
+
+class ShardCatalog:
+    """Persistent index of the date sharded tables in each dataset, stored as json at catalog_path.
+
+    Every refresh still lists the dataset's tables, but only tables created since the previous refresh are
+    parsed and dropped tables are removed from the index. With max_age, an index refreshed less than
+    max_age seconds ago is used as is without listing the tables at all."""
+
+    def __init__(self, catalog_path, max_age=0):
+        self._catalog_path = catalog_path
+        self._max_age = max_age
+
+        if os.path.exists(catalog_path):
+            with open(catalog_path, 'rb') as read_file:
+                self._catalog = json.load(read_file)
+        else:
+            self._catalog = {}
+
+    def get_shards(self, bq_utility, project_id, dataset_id):
+        """Returns a dict of sharded table id to its YYYYMMDD date string."""
+        catalog_key = '%s:%s' % (project_id, dataset_id)
+        catalog_entry = self._catalog.get(catalog_key)
+
+        if catalog_entry is None or time() - catalog_entry['refreshed_at'] > self._max_age:
+            catalog_entry = self._refresh(bq_utility, project_id, dataset_id, catalog_entry)
+            self._catalog[catalog_key] = catalog_entry
+            self._save()
+
+        return catalog_entry['shards']
+
+    def _refresh(self, bq_utility, project_id, dataset_id, catalog_entry):
+        refreshed_at = time()
+
+        if catalog_entry is None:
+            catalog_entry = {'last_creation_time': 0, 'shards': {}}
+
+        last_creation_time = catalog_entry['last_creation_time']
+        table_ids = set()
+        new_table_ids = []
+
+        for table in bq_utility.iter_tables(project_id, dataset_id):
+            table_id = table['tableReference']['tableId']
+            creation_time = int(table.get('creationTime', 0))
+            table_ids.add(table_id)
+
+            # recreated tables get a new creationTime, so older tables were already parsed in a previous refresh
+            if creation_time > catalog_entry['last_creation_time'] or creation_time == 0:
+                new_table_ids.append(table_id)
+
+            last_creation_time = max(last_creation_time, creation_time)
+
+        shards = dict(
+            (table_id, shard_date) for table_id, shard_date in catalog_entry['shards'].items() if table_id in table_ids
+        )
+
+        new_shard_dates = _get_shard_dates(new_table_ids)
+        shards.update(zip(new_shard_dates.index, new_shard_dates.dt.strftime('%Y%m%d')))
+
+        return {
+            'refreshed_at': refreshed_at,
+            'last_creation_time': last_creation_time,
+            'shards': shards
+        }
+
+    def _save(self):
+        temp_path = '%s.%s.tmp' % (self._catalog_path, uuid.uuid4().hex)
+
+        with open(temp_path, 'wb') as write_file:
+            json.dump(self._catalog, write_file)
+
+        if os.path.exists(self._catalog_path):
+            os.remove(self._catalog_path)
+        os.rename(temp_path, self._catalog_path)
+
+
+class StreamingInserter:
+    """Buffered streaming inserts into a table through tabledata.insertAll.
+
+    Rows passed to insert are buffered and sent from a background thread once max_rows rows or max_bytes of
+    json are buffered, or the oldest buffered row has waited max_interval seconds. Each row gets an insertId
+    so BigQuery can deduplicate rows that are sent twice, and only rows that failed with a retryable error
+    are resent. Rows rejected as invalid are kept in failed_rows. Up to max_pending batches are queued
+    before insert blocks. Use as a context manager, or call close when done."""
+
+    # insertErrors reasons for which resending the row can't help
+    _PERMANENT_REASONS = frozenset(['invalid'])
+
+    def __init__(self,
+                 bq_utility,
+                 project_id,
+                 dataset_id,
+                 table_id,
+                 max_rows=500,
+                 max_bytes=5 * 1024 * 1024,
+                 max_interval=1,
+                 max_pending=10,
+                 skip_invalid_rows=False,
+                 ignore_unknown_values=False,
+                 print_details=True):
+
+        assert max_rows > 0 and max_bytes > 0 and max_interval > 0
+
+        self._bq_utility = bq_utility
+        self._project_id = project_id
+        self._dataset_id = dataset_id
+        self._table_id = table_id
+
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._max_interval = max_interval
+        self._skip_invalid_rows = skip_invalid_rows
+        self._ignore_unknown_values = ignore_unknown_values
+        self._print_details = print_details
+
+        self._lock = threading.Lock()
+        self._stale_lock = threading.Lock()
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_started = None
+
+        self._batches = Queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+
+        self.inserted_count = 0
+        self.failed_rows = []
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def insert(self, rows):
+        """Buffers a row dict or a list of row dicts."""
+        assert not self._closed, 'StreamingInserter is closed'
+        self._raise_error()
+
+        if isinstance(rows, dict):
+            rows = [rows]
+
+        for row in rows:
+            row_bytes = len(json.dumps(row))
+            batch = None
+
+            with self._lock:
+                if len(self._buffer) > 0 and self._buffer_bytes + row_bytes > self._max_bytes:
+                    batch = self._take_buffer()
+
+                if len(self._buffer) == 0:
+                    self._buffer_started = time()
+
+                self._buffer.append({'insertId': uuid.uuid4().hex, 'json': row})
+                self._buffer_bytes += row_bytes
+
+                if batch is None and len(self._buffer) >= self._max_rows:
+                    batch = self._take_buffer()
+
+            # queued outside the lock, as a full queue blocks until the sender catches up
+            if batch is not None:
+                self._batches.put(batch)
+
+    def flush(self):
+        """Sends all buffered rows and waits until every queued batch has been sent."""
+        with self._lock:
+            batch = self._take_buffer()
+
+        if len(batch) > 0:
+            self._batches.put(batch)
+
+        self._batches.join()
+
+        # waits for a stale buffer the sender took without going through the queue
+        with self._stale_lock:
+            pass
+
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._batches.put(None)
+            self._thread.join()
+
+        logging_string = '[BigQuery] Streamed %s rows into %s:%s.%s (%s failed)' % (
+            self.inserted_count,
+            self._project_id,
+            self._dataset_id,
+            self._table_id,
+            len(self.failed_rows)
+        )
+
+        if self._print_details:
+            print '\t%s' % logging_string
+
+        if self._bq_utility._logger is not None:
+            self._bq_utility._logger.info(logging_string)
+
+    def _take_buffer(self):
+        batch = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_started = None
+        return batch
+
+    def _take_stale_buffer(self):
+        with self._lock:
+            if self._buffer_started is not None and time() - self._buffer_started >= self._max_interval:
+                return self._take_buffer()
+
+        return None
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=self._max_interval / 2.0)
+            except Queue.Empty:
+                # held from taking the buffer until it's sent, so flush can wait for the send
+                with self._stale_lock:
+                    batch = self._take_stale_buffer()
+                    if batch is not None:
+                        self._send_rows(batch)
+                continue
+
+            try:
+                if batch is None:
+                    break
+                self._send_rows(batch)
+            finally:
+                self._batches.task_done()
+
+    def _send_rows(self, rows):
+        try:
+            self._insert_rows(rows)
+        except Exception as e:
+            # surfaced to the caller on the next insert or flush
+            self.failed_rows += [{'insertId': row['insertId'], 'json': row['json'], 'errors': [{'message': str(e)}]} for row in rows]
+            self._error = e
+
+    def _insert_rows(self, rows):
+        retry_count = 0
+
+        while len(rows) > 0:
+            response = self._bq_utility._tabledata.insertAll(
+                projectId=self._project_id,
+                datasetId=self._dataset_id,
+                tableId=self._table_id,
+                body={
+                    'rows': rows,
+                    'skipInvalidRows': self._skip_invalid_rows,
+                    'ignoreUnknownValues': self._ignore_unknown_values
+                }
+            ).execute(num_retries=self._bq_utility._max_retries)
+
+            insert_errors = response.get('insertErrors', [])
+            self.inserted_count += len(rows) - len(insert_errors)
+
+            retry_rows = []
+            retry_errors = []
+
+            for insert_error in insert_errors:
+                row = rows[insert_error['index']]
+                reasons = set(error.get('reason') for error in insert_error['errors'])
+
+                if reasons & self._PERMANENT_REASONS:
+                    self.failed_rows.append({'insertId': row['insertId'], 'json': row['json'], 'errors': insert_error['errors']})
+                else:
+                    retry_rows.append(row)
+                    retry_errors.append(insert_error['errors'])
+
+            if len(retry_rows) > 0:
+                retry_count += 1
+
+                if retry_count > self._bq_utility._max_retries:
+                    for row, errors in zip(retry_rows, retry_errors):
+                        self.failed_rows.append({'insertId': row['insertId'], 'json': row['json'], 'errors': errors})
+                    break
+
+                sleep(random.random() * (2 ** retry_count))
+
+            rows = retry_rows
+
+
+class JobScheduler:
+    """Runs a dependency graph of BigqueryUtility jobs, e.g. write_table, copy_table, load_from_gcs or export_to_gcs.
+
+    Jobs are started with wait_finish=False as soon as all of the jobs they depend on are DONE, with at most
+    max_concurrent jobs running at once. Running jobs are polled together with one batched request per round.
+    Methods without a wait_finish parameter, such as write_view or delete_table, run to completion when started.
+    A failed job raises once it is seen, and jobs depending on it are never started."""
+
+    def __init__(self, bq_utility, max_concurrent=10, print_details=True, sleep_time=None):
+        assert max_concurrent > 0
+
+        self._bq_utility = bq_utility
+        self._max_concurrent = max_concurrent
+        self._print_details = print_details
+        self._sleep_time = sleep_time
+
+        self._job_dict = OrderedDict()
+
+    def add_job(self, *args, **kwargs):
+        """Adds a call of job_method(**kwargs), e.g. add_job('daily', bq.write_table, ['load'], query=...).
+
+        Takes name, job_method and an optional depends_on positionally, so any keyword is passed through to job_method.
+        Jobs in depends_on must have been added already, so the graph can't contain cycles."""
+        assert 2 <= len(args) <= 3, 'add_job takes name, job_method and optionally depends_on as positional arguments'
+        name, job_method = args[:2]
+        depends_on = args[2] if len(args) > 2 else None
+
+        assert name not in self._job_dict, 'Job %s has already been added' % name
+
+        if depends_on is None:
+            depends_on = []
+        elif isinstance(depends_on, basestring):
+            depends_on = [depends_on]
+
+        for parent_name in depends_on:
+            assert parent_name in self._job_dict, 'Job %s depends on unknown job %s' % (name, parent_name)
+
+        # only passed to methods that take them, e.g. write_view has no wait_finish
+        arg_spec = inspect.getargspec(job_method)
+
+        if 'wait_finish' in arg_spec.args or arg_spec.keywords is not None:
+            kwargs['wait_finish'] = False
+
+        if 'print_details' in arg_spec.args or arg_spec.keywords is not None:
+            kwargs.setdefault('print_details', self._print_details)
+
+        self._job_dict[name] = {
+            'job_method': job_method,
+            'kwargs': kwargs,
+            'depends_on': set(depends_on)
+        }
+
+    def run(self):
+        """Runs all added jobs and returns an OrderedDict of job name to its completed job resource."""
+        completed_dict = dict(self.iter_run())
+        return OrderedDict((name, completed_dict[name]) for name in self._job_dict)
+
+    def iter_run(self):
+        """Runs all added jobs, yielding (job name, completed job resource) as each job finishes."""
+        bq_utility = self._bq_utility
+        completed_dict = OrderedDict()
+        waiting_dict = OrderedDict(self._job_dict.items())
+        running_dict = OrderedDict()
+
+        poll_intervals = None
+
+        while len(waiting_dict) > 0 or len(running_dict) > 0:
+            started_jobs = False
+
+            for name, job in waiting_dict.items():
+                if len(running_dict) >= self._max_concurrent:
+                    break
+
+                if job['depends_on'].issubset(completed_dict):
+                    del waiting_dict[name]
+                    response = job['job_method'](**job['kwargs'])
+
+                    # methods such as write_view finish without a job
+                    if isinstance(response, dict) and 'jobReference' in response:
+                        running_dict['%s:%s' % (response['jobReference']['projectId'], response['jobReference']['jobId'])] = (name, response)
+                        started_jobs = True
+                    else:
+                        completed_dict[name] = response
+                        yield name, response
+
+            if len(running_dict) == 0:
+                continue
+
+            job_statuses = bq_utility._get_job_statuses([running['jobReference'] for _, running in running_dict.values()])
+
+            finished_jobs = False
+            for job_key, response in job_statuses.items():
+                if response['status']['state'] == 'DONE':
+                    name = running_dict.pop(job_key)[0]
+                    completed_dict[name] = bq_utility._log_job_status(response, self._print_details)
+                    finished_jobs = True
+                    yield name, completed_dict[name]
+
+            # polling restarts from the shortest interval whenever the set of running jobs changes
+            if finished_jobs or started_jobs or poll_intervals is None:
+                poll_intervals = bq_utility._get_polling_policy(self._sleep_time).intervals()
+
+            if not finished_jobs and len(running_dict) > 0:
+                sleep(next(poll_intervals))
+
+
+class _TableInfoCache:
+    # in-process lru cache of table resources with a ttl, shared across threads
+    def __init__(self, max_size, ttl):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return None
+
+            stored_at, value = self._cache.pop(key)
+            if time() - stored_at > self._ttl:
+                return None
+
+            self._cache[key] = (stored_at, value)
+
+        # copies so callers modifying the resource don't change the cached entry
+        return deepcopy(value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time(), deepcopy(value))
+
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
 class BigqueryUtility:
-    def __init__(self, logger=None, authentication_type='Default Credentials', credential_file_path=None, user_name=None, client_secret_path=None, max_retries=3):
+    def __init__(self, logger=None, authentication_type='Default Credentials', credential_file_path=None, user_name=None, client_secret_path=None, max_retries=3, polling_policy=None, result_cache=None, table_cache_ttl=0, table_cache_size=1000, estimate_cache_size=1000, table_version_ttl=60):
+        OAUTH_SCOPE = 'https://www.googleapis.com/auth/bigquery'
+
         if authentication_type == 'Default Credentials':
             # try building from application default
             try:
                 credentials = GoogleCredentials.get_application_default()
-                service = build('bigquery', 'v2', credentials=credentials)
+                if credentials.create_scoped_required():
+                    credentials = credentials.create_scoped(OAUTH_SCOPE)
+
+                http = ThreadLocalHttp(credentials)
+                service = build('bigquery', 'v2', http=http)
             except ApplicationDefaultCredentialsError as e:
                 print 'Application Default Credentials unavailable. ' \
                       'To set up Default Credentials, download gcloud from https://cloud.google.com/sdk/gcloud/ ' \
@@ -210,11 +1071,8 @@ class BigqueryUtility:
                 raise e
 
         elif authentication_type == 'Stored Credentials':
-            import httplib2
             from oauth2client.contrib import multistore_file
 
-            OAUTH_SCOPE = 'https://www.googleapis.com/auth/bigquery'
-
             assert user_name is not None and credential_file_path is not None
             storage = multistore_file.get_credential_storage(
                 filename=credential_file_path,
@@ -242,250 +1100,485 @@ class BigqueryUtility:
                 FLOW = flow_from_clientsecrets(client_secret_path, scope=OAUTH_SCOPE)
                 credentials = run_flow(FLOW, storage, flags)
 
-            # Create an httplib2.Http object and authorize it with your credentials
-            http = httplib2.Http()
-            http = credentials.authorize(http)
+            # authorized httplib2.Http objects are created per thread from the credentials
+            http = ThreadLocalHttp(credentials)
+            service = build('bigquery', 'v2', http=http)
+        else:
+            raise TypeError('Authentication types available are "Default Credentials" and "Stored Credentials"')
+
+        self._http = http
+        self._service = service
+        self._datasets = self._service.datasets()
+        self._jobs = self._service.jobs()
+        self._projects = self._service.projects()
+        self._tabledata = self._service.tabledata()
+        self._tables = self._service.tables()
+
+        self._logger = logger
+        self._max_retries = max_retries
+
+        # Retry transport and file IO errors on resumable uploads.
+        self._RETRYABLE_ERRORS = (HttpLib2Error, IOError)
+
+        # Number of bytes to send in each resumable upload request, must be a multiple of 256KB.
+        self._CHUNKSIZE = 8 * 1024 * 1024
+
+        # sleep_time=None on any job method falls back to this policy
+        self._polling_policy = PollingPolicy() if polling_policy is None else polling_policy
+
+        # opt-in QueryResultCache for synchronous queries
+        self._result_cache = result_cache
+
+        # table resources from get_table_info are cached for table_cache_ttl seconds, 0 disables the cache
+        # entries are invalidated when this utility changes the table, changes made elsewhere show up after the ttl
+        self._table_cache = _TableInfoCache(table_cache_size, table_cache_ttl) if table_cache_ttl > 0 else None
+
+        # dry run estimates are checked against table versions on every use, the ttl only bounds staleness of unused entries
+        self._estimate_cache = _TableInfoCache(estimate_cache_size, 24 * 60 * 60)
+
+        # lastModifiedTime of tables referenced by estimates, so repeated queries don't check every table on every call
+        # invalidated along with the table cache, changes made elsewhere show up after table_version_ttl seconds
+        self._table_version_cache = _TableInfoCache(table_cache_size, table_version_ttl) if table_version_ttl > 0 else None
+
+        # number of http requests made by the last call of query, see get_api_call_count
+        self.last_query_api_calls = None
+
+        # created on first use by the list paginator
+        self._prefetch_pool = None
+
+    def _get_prefetch_pool(self):
+        # single long-lived worker so its connection is reused across list calls
+        if self._prefetch_pool is None:
+            self._prefetch_pool = ThreadPool(1)
+        return self._prefetch_pool
+
+    def _iterate_list_pages(self, list_method, items_key, max_results=None, **list_params):
+        """Yields the items of a paginated list call as each page arrives, stopping exactly at max_results.
+
+        The next page is requested in the background while the caller works through the current one."""
+        if max_results is not None:
+            list_params['maxResults'] = max_results
+
+        def _fetch_page(page_token):
+            return list_method(
+                pageToken=page_token,
+                **list_params
+            ).execute(num_retries=self._max_retries)
+
+        item_count = 0
+        pending_page = self._get_prefetch_pool().apply_async(_fetch_page, (None,))
+
+        while pending_page is not None:
+            response = pending_page.get()
+            pending_page = None
+
+            items = response.get(items_key, [])
+
+            if 'nextPageToken' in response and (max_results is None or item_count + len(items) < max_results):
+                pending_page = self._get_prefetch_pool().apply_async(_fetch_page, (response['nextPageToken'],))
+
+            for item in items:
+                if max_results is not None and item_count >= max_results:
+                    return
+
+                yield item
+                item_count += 1
+
+    def iter_projects(self, max_results=None):
+        return self._iterate_list_pages(self._projects.list, 'projects', max_results)
+
+    def list_projects(self, max_results=None):
+        return list(self.iter_projects(max_results))
+
+    def iter_jobs(self, project_id, state_filter=None, show_all_users=False, max_results=None):
+        return self._iterate_list_pages(
+            self._jobs.list,
+            'jobs',
+            max_results,
+            projectId=project_id,
+            allUsers=show_all_users,
+            stateFilter=state_filter
+        )
+
+    def list_jobs(self, project_id, state_filter=None, show_all_users=False, max_results=None):
+        return list(self.iter_jobs(project_id, state_filter, show_all_users, max_results))
+
+    def iter_datasets(self, project_id, show_all=False, max_results=None):
+        return self._iterate_list_pages(
+            self._datasets.list,
+            'datasets',
+            max_results,
+            projectId=project_id,
+            all=show_all
+        )
+
+    def list_datasets(self, project_id, show_all=False, max_results=None):
+        return list(self.iter_datasets(project_id, show_all, max_results))
+
+    def iter_tables(self, project_id, dataset_id, max_results=None):
+        return self._iterate_list_pages(
+            self._tables.list,
+            'tables',
+            max_results,
+            projectId=project_id,
+            datasetId=dataset_id
+        )
+
+    def list_tables(self, project_id, dataset_id, max_results=None):
+        return list(self.iter_tables(project_id, dataset_id, max_results))
+
+    def get_job(self, project_id, job_id):
+        return self._jobs.get(
+            projectId=project_id,
+            jobId=job_id
+        ).execute(num_retries=self._max_retries)
+
+    def _get_polling_policy(self, sleep_time):
+        if sleep_time is None:
+            return self._polling_policy
+        elif isinstance(sleep_time, PollingPolicy):
+            return sleep_time
+        else:
+            # fixed interval, kept for callers passing sleep_time in seconds
+            return PollingPolicy(initial_interval=sleep_time, max_interval=sleep_time, jitter=0)
+
+    def get_table_info(self, project_id, dataset_id, table_id, use_cache=True):
+        use_cache = use_cache and self._table_cache is not None
+
+        if use_cache:
+            response = self._table_cache.get((project_id, dataset_id, table_id))
+            if response is not None:
+                return response
+
+        response = self._tables.get(
+            projectId=project_id,
+            datasetId=dataset_id,
+            tableId=table_id
+        ).execute(num_retries=self._max_retries)
 
-            service = build('bigquery', 'v2', http=http)
-        else:
-            raise TypeError('Authentication types available are "Default Credentials" and "Stored Credentials"')
+        if use_cache:
+            self._table_cache.set((project_id, dataset_id, table_id), response)
 
-        self._service = service
-        self._datasets = self._service.datasets()
-        self._jobs = self._service.jobs()
-        self._projects = self._service.projects()
-        self._tabledata = self._service.tabledata()
-        self._tables = self._service.tables()
+        return response
 
-        self._logger = logger
-        self._max_retries = max_retries
+    def _invalidate_table_info(self, project_id, dataset_id, table_id):
+        if self._table_cache is not None:
+            self._table_cache.invalidate((project_id, dataset_id, table_id))
 
-    def list_projects(self, max_results=None):
-        project_list = []
-        project_count = 0
+        if self._table_version_cache is not None:
+            self._table_version_cache.invalidate((project_id, dataset_id, table_id))
 
-        response = self._projects.list().execute(num_retries=self._max_retries)
+    def _invalidate_job_destination(self, response):
+        # called when a job is submitted and again when it's done, as the table changes in between
+        for job_type in ('query', 'load', 'copy'):
+            destination_table = response.get('configuration', {}).get(job_type, {}).get('destinationTable')
 
-        if 'projects' in response:
-            project_list += response['projects']
-            project_count += len(response['projects'])
-        else:
-            return project_list
+            if destination_table is not None:
+                self._invalidate_table_info(
+                    destination_table['projectId'],
+                    destination_table['datasetId'],
+                    destination_table['tableId']
+                )
 
-        if project_count > max_results:
-            project_list = project_list[:max_results]
-            return project_list
+    def get_sharded_date_range(self, project_id, dataset_id, print_details=True, catalog=None):
+        """Finds date sharded tables (names ending in YYYYMMDD) and the missing dates of each shard group.
 
-        while 'nextPageToken' in response:
-            page_token = None
-            if 'nextPageToken' in response:
-                page_token = response['nextPageToken']
+        catalog takes a ShardCatalog to persist the shard index between runs and refresh it incrementally."""
+        shard_dates = self._get_shard_dates_for_dataset(project_id, dataset_id, catalog)
 
-            response = self._projects.list(
-                pageToken=page_token
-            ).execute(num_retries=self._max_retries)
+        returnDict = {}
 
-            if 'projects' in response:
-                project_list += response['projects']
-                project_count += len(response['projects'])
+        if len(shard_dates) > 0:
+            for key, group_dates in shard_dates.groupby(shard_dates.index.str[:-8]):
+                tableDateIndex = pd.DatetimeIndex(group_dates.values).unique()
+                min_date = tableDateIndex.min()
+                max_date = tableDateIndex.max()
 
-            if project_count > max_results:
-                project_list = project_list[:max_results]
-                break
+                # set difference against the full range instead of a membership test per date
+                missing_dates = pd.date_range(min_date, max_date).difference(tableDateIndex)
 
-        return project_list
+                returnDict[key] = {
+                    'min_date': min_date.to_pydatetime(),
+                    'max_date': max_date.to_pydatetime(),
+                    'missing_dates': list(missing_dates.to_pydatetime())
+                }
 
-    def list_jobs(self, project_id, state_filter=None, show_all_users=False, max_results=None):
-        job_list = []
-        job_count = 0
+            if print_details:
+                for key in returnDict.keys():
+                    print 'Group Name: %s' % key
+                    print 'Min Date: %s' % returnDict[key]['min_date'].strftime('%Y-%m-%d')
+                    print 'Max Date: %s' % returnDict[key]['max_date'].strftime('%Y-%m-%d')
+                    print 'Missing Dates: %s' % ', '.join([x.strftime('%Y-%m-%d') for x in returnDict[key]['missing_dates']])
+                    print
+        else:
+            raise ValueError('No sharded tables found')
 
-        response = self._jobs.list(
-            projectId=project_id,
-            allUsers=show_all_users,
-            stateFilter=state_filter
-        ).execute(num_retries=self._max_retries)
+        return returnDict
 
-        if 'jobs' in response:
-            job_list += response['jobs']
-            job_count += len(response['jobs'])
+    def _get_shard_dates_for_dataset(self, project_id, dataset_id, catalog):
+        # shard dates indexed by table id, from the catalog if given or else by listing the dataset's tables
+        if catalog is not None:
+            shard_dates = pd.to_datetime(pd.Series(catalog.get_shards(self, project_id, dataset_id)), format='%Y%m%d')
         else:
-            return job_list
-
-        if job_count > max_results:
-            job_list = job_list[:max_results]
-            return job_list
-
-        while 'nextPageToken' in response:
-            page_token = None
-            if 'nextPageToken' in response:
-                page_token = response['nextPageToken']
-
-            response = self._jobs.list(
-                projectId=project_id,
-                allUsers=show_all_users,
-                stateFilter=state_filter,
-                pageToken=page_token
-            ).execute(num_retries=self._max_retries)
+            shard_dates = _get_shard_dates(
+                [table['tableReference']['tableId'] for table in self.iter_tables(project_id, dataset_id, max_results=100000)]
+            )
 
-            if 'jobs' in response:
-                job_list += response['jobs']
-                job_count += len(response['jobs'])
+        return shard_dates
 
-            if job_count > max_results:
-                job_list = job_list[:max_results]
-                break
+    def _get_shard_table_ids(self, project_id, dataset_id, shard_group, start_date=None, end_date=None, catalog=None):
+        # shard table ids of one group within the date range, oldest first
+        shard_dates = self._get_shard_dates_for_dataset(project_id, dataset_id, catalog)
 
-        return job_list
+        shard_dates = shard_dates[shard_dates.index.str[:-8] == shard_group]
 
-    def list_datasets(self, project_id, show_all=False, max_results=None):
-        dataset_list = []
-        dataset_count = 0
+        if start_date is not None:
+            shard_dates = shard_dates[shard_dates >= pd.Timestamp(start_date)]
 
-        response = self._datasets.list(
-            projectId=project_id,
-            all=show_all
-        ).execute(num_retries=self._max_retries)
+        if end_date is not None:
+            shard_dates = shard_dates[shard_dates <= pd.Timestamp(end_date)]
 
-        if 'datasets' in response:
-            dataset_list += response['datasets']
-            dataset_count += len(response['datasets'])
-        else:
-            return dataset_list
+        if len(shard_dates) == 0:
+            raise ValueError('No shards of %s found in %s:%s' % (shard_group, project_id, dataset_id))
 
-        if dataset_count > max_results:
-            dataset_list = dataset_list[:max_results]
-            return dataset_list
+        return list(shard_dates.sort_values().index)
 
-        while 'nextPageToken' in response:
-            page_token = None
-            if 'nextPageToken' in response:
-                page_token = response['nextPageToken']
+    def _log_shard_progress(self, operation, shard_group, completed_count, total_count, print_details):
+        logging_string = '[BigQuery] %s %s shards (%s/%s)' % (operation, shard_group, completed_count, total_count)
 
-            response = self._datasets.list(
-                projectId=project_id,
-                all=show_all,
-                pageToken=page_token
-            ).execute(num_retries=self._max_retries)
+        if print_details:
+            print '\t%s' % logging_string
+
+        if self._logger is not None:
+            self._logger.info(logging_string)
 
-            if 'datasets' in response:
-                dataset_list += response['datasets']
-                dataset_count += len(response['datasets'])
+    def _run_shard_jobs(self, operation, shard_group, job_calls, max_workers, print_details, sleep_time):
+        # job_calls are (table_id, job_method, kwargs), run through a JobScheduler with one combined progress report
+        scheduler = JobScheduler(self, max_concurrent=max_workers, print_details=False, sleep_time=sleep_time)
 
-            if dataset_count > max_results:
-                dataset_list = dataset_list[:max_results]
-                break
+        for table_id, job_method, kwargs in job_calls:
+            scheduler.add_job(table_id, job_method, **kwargs)
 
-        return dataset_list
+        completed_dict = {}
+        for table_id, response in scheduler.iter_run():
+            completed_dict[table_id] = response
+            self._log_shard_progress(operation, shard_group, len(completed_dict), len(job_calls), print_details)
 
-    def list_tables(self, project_id, dataset_id, max_results=None):
-        table_list = []
-        table_count = 0
+        return OrderedDict((table_id, completed_dict[table_id]) for table_id, job_method, kwargs in job_calls)
 
-        response = self._tables.list(
-            projectId=project_id,
-            datasetId=dataset_id
-        ).execute(num_retries=self._max_retries)
+    def copy_shards(self,
+                    project_id,
+                    dataset_id,
+                    shard_group,
+                    write_data,
+                    start_date=None,
+                    end_date=None,
+                    writeDisposition='WRITE_TRUNCATE',
+                    max_workers=10,
+                    print_details=True,
+                    sleep_time=None,
+                    catalog=None):
+        """Copies every shard of shard_group (a group name from get_sharded_date_range) between start_date and end_date.
+
+        write_data takes the destination projectId and datasetId, and optionally the tablePrefix of the copies
+        which defaults to shard_group. Up to max_workers copy jobs run at once. Returns an OrderedDict of
+        source table id to its completed job resource."""
+        table_prefix = write_data.get('tablePrefix', shard_group)
+
+        job_calls = [
+            (
+                table_id,
+                self.copy_table,
+                {
+                    'write_data': {
+                        'projectId': write_data['projectId'],
+                        'datasetId': write_data['datasetId'],
+                        'tableId': table_prefix + table_id[-8:]
+                    },
+                    'copy_data': {
+                        'projectId': project_id,
+                        'datasetId': dataset_id,
+                        'tableId': table_id
+                    },
+                    'writeDisposition': writeDisposition
+                }
+            ) for table_id in self._get_shard_table_ids(project_id, dataset_id, shard_group, start_date, end_date, catalog)
+        ]
 
-        if 'tables' in response:
-            table_list += response['tables']
-            table_count += len(response['tables'])
-        else:
-            return table_list
+        return self._run_shard_jobs('Copied', shard_group, job_calls, max_workers, print_details, sleep_time)
 
-        if table_count > max_results:
-            table_list = table_list[:max_results]
-            return table_list
+    def export_shards(self,
+                      project_id,
+                      dataset_id,
+                      shard_group,
+                      destinationUri,
+                      start_date=None,
+                      end_date=None,
+                      compression='NONE',
+                      destinationFormat='CSV',
+                      max_workers=10,
+                      print_details=True,
+                      sleep_time=None,
+                      catalog=None):
+        """Exports every shard of shard_group between start_date and end_date to GCS.
+
+        destinationUri must contain a %s which is filled with each shard's table id,
+        e.g. gs://bucket/exports/%s/*.csv. Up to max_workers extract jobs run at once."""
+        assert '%s' in destinationUri, 'destinationUri must contain %s for the shard table id'
+
+        job_calls = [
+            (
+                table_id,
+                self.export_to_gcs,
+                {
+                    'read_project_id': project_id,
+                    'read_dataset_id': dataset_id,
+                    'read_table_id': table_id,
+                    'destinationUri': destinationUri % table_id,
+                    'compression': compression,
+                    'destinationFormat': destinationFormat
+                }
+            ) for table_id in self._get_shard_table_ids(project_id, dataset_id, shard_group, start_date, end_date, catalog)
+        ]
+
+        return self._run_shard_jobs('Exported', shard_group, job_calls, max_workers, print_details, sleep_time)
+
+    def delete_shards(self,
+                      project_id,
+                      dataset_id,
+                      shard_group,
+                      start_date=None,
+                      end_date=None,
+                      max_workers=10,
+                      print_details=True,
+                      catalog=None):
+        """Deletes every shard of shard_group between start_date and end_date on max_workers threads.
 
-        while 'nextPageToken' in response:
-            page_token = None
-            if 'nextPageToken' in response:
-                page_token = response['nextPageToken']
+        Returns the list of deleted table ids."""
+        table_ids = self._get_shard_table_ids(project_id, dataset_id, shard_group, start_date, end_date, catalog)
 
-            response = self._tables.list(
-                projectId=project_id,
-                datasetId=dataset_id,
-                pageToken=page_token
-            ).execute(num_retries=self._max_retries)
+        def _delete_shard(table_id):
+            self.delete_table(project_id, dataset_id, table_id, print_details=False)
+            return table_id
 
-            if 'tables' in response:
-                table_list += response['tables']
-                table_count += len(response['tables'])
+        pool = ThreadPool(min(max_workers, len(table_ids)))
+        try:
+            for completed_count, table_id in enumerate(pool.imap_unordered(_delete_shard, table_ids), 1):
+                self._log_shard_progress('Deleted', shard_group, completed_count, len(table_ids), print_details)
+        finally:
+            pool.close()
 
-            if table_count > max_results:
-                table_list = table_list[:max_results]
-                break
+        return table_ids
 
-        return table_list
+    def _dry_run_query(self, project_id, query, udfInlineCode=None):
+        request_body = {
+            'configuration': {
+                'query': {
+                    'query': query
+                },
+                'dryRun': True
+            }
+        }
 
-    def get_job(self, project_id, job_id):
-        return self._jobs.get(
-            projectId=project_id,
-            jobId=job_id
-        ).execute(num_retries=self._max_retries)
+        if udfInlineCode is not None:
+            request_body['configuration']['query']['userDefinedFunctionResources'] = [{'inlineCode': udfInlineCode}]
 
-    def get_table_info(self, project_id, dataset_id, table_id):
-        return self._tables.get(
+        return self._jobs.insert(
             projectId=project_id,
-            datasetId=dataset_id,
-            tableId=table_id
+            body=request_body
         ).execute(num_retries=self._max_retries)
 
-    def get_sharded_date_range(self, project_id, dataset_id, print_details=True):
-        tableList = self.list_tables(project_id, dataset_id, max_results=100000)
+    def _get_table_versions(self, referenced_tables, batch_size=50):
+        version_dict = {}
+        table_keys = sorted(set((table['projectId'], table['datasetId'], table['tableId']) for table in referenced_tables))
+
+        if self._table_version_cache is not None:
+            for table_key in table_keys:
+                last_modified_time = self._table_version_cache.get(table_key)
+                if last_modified_time is not None:
+                    version_dict[table_key] = last_modified_time
+
+        # tables missing from the cache are fetched with one batched http request per batch_size tables
+        missing_keys = [table_key for table_key in table_keys if table_key not in version_dict]
+
+        def _batch_callback(request_id, response, exception):
+            if exception is not None:
+                raise exception
+
+            version_dict[missing_keys[int(request_id)]] = response['lastModifiedTime']
+
+        for batch_start in range(0, len(missing_keys), batch_size):
+            batch = self._service.new_batch_http_request(callback=_batch_callback)
+
+            for key_index in range(batch_start, min(batch_start + batch_size, len(missing_keys))):
+                project_id, dataset_id, table_id = missing_keys[key_index]
+                batch.add(
+                    self._tables.get(
+                        projectId=project_id,
+                        datasetId=dataset_id,
+                        tableId=table_id,
+                        fields='lastModifiedTime'
+                    ),
+                    request_id=str(key_index)
+                )
 
-        tableDict = {}
-        returnDict = {}
+            batch.execute()
 
-        for table in tableList:
-            tableName = table['tableReference']['tableId']
-            groupName = tableName[:-8]
+        if self._table_version_cache is not None:
+            for table_key in missing_keys:
+                self._table_version_cache.set(table_key, version_dict[table_key])
 
-            try:
-                tableDate = pd.datetime.strptime(tableName[-8:], '%Y%m%d')
+        return [list(table_key) + [version_dict[table_key]] for table_key in table_keys]
 
-                if groupName not in tableDict:
-                    tableDict[groupName] = []
+    def estimate_query(self, project_id, query, udfInlineCode=None, use_cache=True):
+        """Dry runs a query and returns a dict of totalBytesProcessed, referencedTables and tableVersions.
 
-                tableDict[groupName].append(tableDate)
-            except ValueError:
-                pass
+        Estimates are cached by the SQL and reused while the lastModifiedTime of every referenced table
+        is unchanged. Table versions are cached for table_version_ttl seconds and otherwise fetched
+        in one batched request, so a cached estimate usually costs no http requests at all."""
+        sql_key = hashlib.sha1(
+            json.dumps([project_id, query.strip(), udfInlineCode])
+        ).hexdigest()
 
-        if len(tableDict) > 0:
-            for key in tableDict.keys():
-                tableDateList = tableDict[key]
-                min_date = min(tableDateList)
-                max_date = max(tableDateList)
+        if use_cache:
+            estimate = self._estimate_cache.get(sql_key)
 
-                dateRange = list(pd.date_range(min_date, max_date))
-                missing_dates = [x.to_datetime() for x in dateRange if x not in tableDateList]
+            if estimate is not None and self._get_table_versions(estimate['referencedTables']) == estimate['tableVersions']:
+                return estimate
 
-                returnDict[key] = {
-                    'min_date': min_date,
-                    'max_date': max_date,
-                    'missing_dates': missing_dates
-                }
+        dry_run_response = self._dry_run_query(project_id, query, udfInlineCode)
+        referenced_tables = dry_run_response['statistics']['query'].get('referencedTables', [])
 
-            if print_details:
-                for key in returnDict.keys():
-                    print 'Group Name: %s' % key
-                    print 'Min Date: %s' % returnDict[key]['min_date'].strftime('%Y-%m-%d')
-                    print 'Max Date: %s' % returnDict[key]['max_date'].strftime('%Y-%m-%d')
-                    print 'Missing Dates: %s' % ', '.join([x.strftime('%Y-%m-%d') for x in returnDict[key]['missing_dates']])
-                    print
-        else:
-            raise ValueError('No sharded tables found')
+        estimate = {
+            'totalBytesProcessed': int(dry_run_response['statistics']['totalBytesProcessed']),
+            'referencedTables': referenced_tables,
+            'tableVersions': self._get_table_versions(referenced_tables)
+        }
 
-        return returnDict
+        self._estimate_cache.set(sql_key, estimate)
 
-    def _get_query_schema(self, response):
+        return estimate
 
-        response = self._jobs.getQueryResults(
-                projectId=response['jobReference']['projectId'],
-                jobId=response['jobReference']['jobId'],
-                maxResults=0
-            ).execute(num_retries=self._max_retries)
+    def _check_maximum_bytes(self, project_id, query, udfInlineCode, maximum_bytes):
+        if maximum_bytes is None:
+            return
+
+        total_bytes = self.estimate_query(project_id, query, udfInlineCode)['totalBytesProcessed']
+
+        if total_bytes > maximum_bytes:
+            raise ValueError('Query would process %s, above maximum_bytes of %s' % (
+                humanize.naturalsize(total_bytes),
+                humanize.naturalsize(maximum_bytes)
+            ))
+
+    def _get_query_cache_key(self, project_id, query):
+        # referenced tables and their current versions come from the query estimate
+        table_versions = self.estimate_query(project_id, query)['tableVersions']
 
-        return response['schema']['fields']
+        # only surrounding whitespace is stripped, whitespace inside string literals changes results
+        return hashlib.sha1(
+            json.dumps([project_id, query.strip(), table_versions])
+        ).hexdigest()
 
     def delete_table(self, project_id, dataset_id, table_id, print_details=True):
         self._tables.delete(
@@ -494,6 +1587,8 @@ class BigqueryUtility:
             tableId=table_id
         ).execute(num_retries=self._max_retries)
 
+        self._invalidate_table_info(project_id, dataset_id, table_id)
+
         logging_string = '[BigQuery] Deleted %s:%s:%s' % (project_id, dataset_id, table_id)
 
         if print_details:
@@ -502,16 +1597,45 @@ class BigqueryUtility:
         if self._logger is not None:
             self._logger.info(logging_string)
 
-    def query(self, project_id, query, async=False, async_data=None, udfInlineCode=None, return_type='list', print_details=True, sleep_time=1):
+    def query(self, project_id, query, async=False, async_data=None, udfInlineCode=None, return_type='list', print_details=True, sleep_time=None, fetch_workers=None, maximum_bytes=None):
         """Submit a query to bigquery. Users can choose whether to submit an
-        asynchronous or synchronous query (default)."""
+        asynchronous or synchronous query (default).
+
+        return_type='iterator' returns a generator of rows (header row first) that
+        fetches each result page only as it is consumed, for results too large to hold in memory.
+
+        fetch_workers > 1 fetches result pages concurrently on that many threads once the job is done.
+
+        With maximum_bytes, the query is dry run first and a ValueError is raised instead of submitting it
+        if it would process more bytes than that.
+
+        The number of http requests the call made is kept in last_query_api_calls. For the iterator
+        return type, only the requests made before the first page is returned are counted."""
+        api_call_count = self.get_api_call_count()
+
+        results = self._query(project_id, query, async, async_data, udfInlineCode, return_type, print_details, sleep_time, fetch_workers, maximum_bytes)
+
+        self.last_query_api_calls = self.get_api_call_count() - api_call_count
+
+        if self._logger is not None:
+            self._logger.info('[BigQuery] Query made %d API calls' % self.last_query_api_calls)
+
+        return results
+
+    def get_api_call_count(self):
+        """Returns the number of http requests made through this utility, across all threads."""
+        return self._http.request_count
+
+    def _query(self, project_id, query, async, async_data, udfInlineCode, return_type, print_details, sleep_time, fetch_workers, maximum_bytes):
+        self._check_maximum_bytes(project_id, query, udfInlineCode if async else None, maximum_bytes)
+
         if async:
             # projectId, datasetId and tableId must be filled for async queries
             write_project_id = async_data['projectId']
             write_dataset_id = async_data['datasetId']
             write_table_id = async_data['tableId']
 
-            return self._async_query(project_id, query, write_project_id, write_dataset_id, write_table_id, udfInlineCode, return_type, print_details, sleep_time)
+            return self._async_query(project_id, query, write_project_id, write_dataset_id, write_table_id, udfInlineCode, return_type, print_details, sleep_time, fetch_workers)
         else:
             if udfInlineCode is not None:
                 print 'WARNING: UDF is not enabled for sync queries, please use async if UDF is required'
@@ -519,12 +1643,30 @@ class BigqueryUtility:
                 if self._logger is not None:
                     self._logger.warn('UDF is not enabled for sync queries, please use async if UDF is required')
 
-            return self._sync_query(project_id, query, return_type, print_details, sleep_time)
+            return self._sync_query(project_id, query, return_type, print_details, sleep_time, fetch_workers)
+
+    def _sync_query(self, project_id, query, return_type, print_details, sleep_time, fetch_workers):
+        cache_key = None
+
+        if self._result_cache is not None:
+            cache_key = self._get_query_cache_key(project_id, query)
+            value_pages = self._result_cache.get(cache_key)
+
+            if value_pages is not None:
+                logging_string = '[BigQuery] Synchronous Query (%s) returned from result cache' % project_id
+
+                if print_details:
+                    print '\t%s' % logging_string
+
+                if self._logger is not None:
+                    self._logger.info(logging_string)
+
+                return self._format_query_results(value_pages, return_type)
 
-    def _sync_query(self, project_id, query, return_type, print_details, sleep_time):
+        # small queries finish within the long poll and return their first page straight away
         request_body = {
             'query': query,
-            'timeoutMs': 0
+            'timeoutMs': self._get_polling_policy(sleep_time).long_poll_ms
         }
 
         response = self._jobs.query(
@@ -532,9 +1674,9 @@ class BigqueryUtility:
             body=request_body
         ).execute(num_retries=self._max_retries)
 
-        return self._iterate_job_results(response, return_type, print_details, sleep_time)
+        return self._iterate_job_results(response, return_type, print_details, sleep_time, fetch_workers, cache_key)
 
-    def _async_query(self, project_id, query, write_project_id, write_dataset_id, write_table_id, udfInlineCode, return_type, print_details, sleep_time):
+    def _async_query(self, project_id, query, write_project_id, write_dataset_id, write_table_id, udfInlineCode, return_type, print_details, sleep_time, fetch_workers):
         request_body = {
             'jobReference': {
                 'projectId': project_id,
@@ -564,88 +1706,298 @@ class BigqueryUtility:
             body=request_body
         ).execute(num_retries=self._max_retries)
 
-        return self._iterate_job_results(response, return_type, print_details, sleep_time)
+        self._invalidate_job_destination(response)
 
-    def _iterate_job_results(self, response, return_type, print_details, sleep_time):
-        response = self.poll_job_status(response, print_details, sleep_time)
+        return self._iterate_job_results(response, return_type, print_details, sleep_time, fetch_workers)
 
-        returnList = []
+    def extract_query(self,
+                      project_id,
+                      query,
+                      write_data,
+                      gcs_utility,
+                      gcs_prefix,
+                      return_type='dataframe',
+                      udfInlineCode=None,
+                      max_workers=8,
+                      delete_temp=True,
+                      print_details=True,
+                      sleep_time=None):
+        """Runs a query into the write_data table, exports it as gzipped CSV files and reads them back.
 
-        job_reference = response['jobReference']
-        isComplete = False
+        For results too large to page through getQueryResults. The files are written under gcs_prefix
+        (gs://bucket/path), downloaded on max_workers threads through the GcsUtility gcs_utility and
+        decompressed as they are read. return_type is list, dataframe or iterator as in query, with the
+        values as exported, so empty strings come back as nulls. Nested and repeated fields can't be
+        exported as CSV. With delete_temp, the exported files and the write_data table are deleted afterwards."""
+        assert gcs_prefix.startswith('gs://'), 'gcs_prefix should be in the form gs://bucket/path'
+
+        self.write_table(project_id, query, write_data, udfInlineCode=udfInlineCode, print_details=print_details, sleep_time=sleep_time)
+
+        bucket_name, _, object_path = gcs_prefix[len('gs://'):].partition('/')
+        object_prefix = '%s%s-' % (object_path.rstrip('/') + '/' if object_path else '', uuid.uuid4())
+
+        try:
+            self.export_to_gcs(
+                write_data['projectId'],
+                write_data['datasetId'],
+                write_data['tableId'],
+                'gs://%s/%s*.csv.gz' % (bucket_name, object_prefix),
+                compression='GZIP',
+                print_details=print_details,
+                sleep_time=sleep_time
+            )
+
+            schema_fields = self.get_table_info(write_data['projectId'], write_data['datasetId'], write_data['tableId'])['schema']['fields']
+            object_names = sorted(item['name'] for item in gcs_utility.list_objects(bucket_name, object_prefix))
+        except Exception:
+            if delete_temp:
+                self._delete_extracted(gcs_utility, bucket_name, object_prefix, write_data, max_workers, print_details)
+            raise
+
+        value_pages = self._iterate_extracted_pages(
+            gcs_utility, bucket_name, object_prefix, object_names, schema_fields, write_data, max_workers, delete_temp, print_details
+        )
+
+        # started here so the cleanup in its finally also runs for an iterator that is dropped unconsumed
+        first_pages = list(islice(value_pages, 1))
+
+        return self._format_query_results(chain(first_pages, value_pages), return_type)
+
+    def _delete_extracted(self, gcs_utility, bucket_name, object_prefix, write_data, max_workers, print_details):
+        # removes every exported file under object_prefix, including those of a failed export, and the table
+        object_names = [item['name'] for item in gcs_utility.list_objects(bucket_name, object_prefix)]
+
+        delete_pool = ThreadPool(max(1, min(max_workers, len(object_names))))
+        try:
+            delete_pool.map(lambda object_name: gcs_utility.delete_object(bucket_name, object_name, print_details=print_details), object_names)
+        finally:
+            delete_pool.close()
+
+        self.delete_table(write_data['projectId'], write_data['datasetId'], write_data['tableId'], print_details=print_details)
 
-        while not isComplete or 'pageToken' in response:
-            page_token = None
-            if 'pageToken' in response:
-                page_token = response['pageToken']
+    def _iterate_extracted_pages(self, gcs_utility, bucket_name, object_prefix, object_names, schema_fields, write_data, max_workers, delete_temp, print_details, page_size=10000):
+        temp_dir = tempfile.mkdtemp()
 
+        def _download_file(object_name):
+            write_path = os.path.join(temp_dir, object_name.replace('/', '_'))
+            gcs_utility.download_object(bucket_name, object_name, write_path, print_details=print_details)
+            return write_path
+
+        pool = ThreadPool(max(1, min(max_workers, len(object_names))))
+        try:
+            # files are downloaded ahead in parallel and read in order as each one finishes
+            for read_path in pool.imap(_download_file, object_names):
+                with gzip.open(read_path, 'rb') as read_file:
+                    reader = csv.reader(read_file, encoding='utf-8')
+                    next(reader, None)
+
+                    rows = []
+                    for row in reader:
+                        rows.append([value if value != '' else None for value in row])
+
+                        if len(rows) >= page_size:
+                            yield schema_fields, rows
+                            rows = []
+
+                    if len(rows) > 0:
+                        yield schema_fields, rows
+
+                os.remove(read_path)
+        finally:
+            # runs when the pages are exhausted, on errors, and when an unfinished iterator is closed or collected
+            pool.terminate()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+            if delete_temp:
+                self._delete_extracted(gcs_utility, bucket_name, object_prefix, write_data, max_workers, print_details)
+
+    def _get_result_rows(self, job_reference, start_index, row_count):
+        # a page can come back short of maxResults when it hits the response size limit, keep going until filled
+        rows = []
+        while len(rows) < row_count:
             response = self._jobs.getQueryResults(
                 projectId=job_reference['projectId'],
                 jobId=job_reference['jobId'],
-                timeoutMs=0,
-                pageToken=page_token
+                startIndex=start_index + len(rows),
+                maxResults=row_count - len(rows)
             ).execute(num_retries=self._max_retries)
 
-            isComplete = response['jobComplete']
+            if 'rows' not in response:
+                break
+
+            rows += response['rows']
+
+        return rows
+
+    def _wait_for_query_results(self, response, polling_policy, print_details):
+        """Waits for a query job and returns its job resource and first page of results, logging the job.
+
+        A jobs.query response that completed within its timeoutMs is used as the first page, otherwise
+        getQueryResults is long polled until the job completes. The job resource is then fetched once,
+        and the first page's totalRows is used for the log instead of another getQueryResults call."""
+        job_reference = response['jobReference']
+        query_error = None
+
+        try:
+            while not response.get('jobComplete', False):
+                # timeoutMs only holds the request while the job is still running, completed pages return immediately
+                response = self._jobs.getQueryResults(
+                    projectId=job_reference['projectId'],
+                    jobId=job_reference['jobId'],
+                    timeoutMs=polling_policy.long_poll_ms
+                ).execute(num_retries=self._max_retries)
+        except HttpError as e:
+            # failed jobs are raised from the job resource below, the same way as poll_job_status
+            if e.resp.status >= 500:
+                raise
+            query_error = e
+
+        job = self._jobs.get(
+            projectId=job_reference['projectId'],
+            jobId=job_reference['jobId']
+        ).execute(num_retries=self._max_retries)
+
+        if query_error is not None:
+            self._log_job_status(job, print_details)
+            raise query_error
+
+        return self._log_job_status(job, print_details, response), response
+
+    def _iterate_result_pages(self, job_reference, response, fetch_workers=None):
+        """Yields the schema fields and rows of each getQueryResults page, starting from the completed first page response.
 
-            if 'rows' in response:
-                if page_token is None:
-                    returnList.append([item['name'] for item in response['schema']['fields']])
+        With fetch_workers, the pages after the first are fetched as startIndex/maxResults ranges
+        on a pool of that many threads once totalRows is known, and yielded in order."""
+        if 'rows' not in response:
+            return
 
-                for row in response['rows']:
-                    returnList.append([item['v'] for item in row['f']])
+        schema_fields = response['schema']['fields']
+        yield schema_fields, response['rows']
 
-            sleep(sleep_time)
+        if fetch_workers is not None and fetch_workers > 1 and 'pageToken' in response:
+            total_rows = int(response['totalRows'])
+            page_size = len(response['rows'])
 
+            page_ranges = [
+                (start_index, min(page_size, total_rows - start_index))
+                for start_index in range(page_size, total_rows, page_size)
+            ]
+
+            pool = ThreadPool(fetch_workers)
+            try:
+                # fetched a window at a time so unconsumed pages don't pile up in memory
+                for window_start in range(0, len(page_ranges), fetch_workers):
+                    window_rows = pool.map(
+                        lambda page_range: self._get_result_rows(job_reference, *page_range),
+                        page_ranges[window_start:window_start + fetch_workers]
+                    )
+
+                    for rows in window_rows:
+                        yield schema_fields, rows
+            finally:
+                pool.terminate()
+
+        else:
+            page_token = response.get('pageToken')
+
+            while page_token is not None:
+                response = self._jobs.getQueryResults(
+                    projectId=job_reference['projectId'],
+                    jobId=job_reference['jobId'],
+                    pageToken=page_token
+                ).execute(num_retries=self._max_retries)
+
+                page_token = response.get('pageToken')
+
+                if 'rows' in response:
+                    yield schema_fields, response['rows']
+
+    def _iterate_value_pages(self, job_reference, first_page, fetch_workers=None):
+        for schema_fields, rows in self._iterate_result_pages(job_reference, first_page, fetch_workers):
+            yield schema_fields, [[item['v'] for item in row['f']] for row in rows]
+
+    def _iterate_page_rows(self, value_pages):
+        # header row is yielded first, same as the list return type
+        is_first_page = True
+
+        for schema_fields, rows in value_pages:
+            if is_first_page:
+                yield [item['name'] for item in schema_fields]
+                is_first_page = False
+
+            for row in rows:
+                yield row
+
+    def _format_query_results(self, value_pages, return_type):
         if return_type == 'list':
-            return returnList
+            return list(self._iterate_page_rows(value_pages))
+
+        elif return_type == 'iterator':
+            # rows are only fetched as the iterator is consumed, one page held in memory at a time
+            return self._iterate_page_rows(value_pages)
+
         elif return_type == 'dataframe':
-            query_schema = self._get_query_schema(response)
+            query_schema = None
+            column_values = None
 
-            def _convert_timestamp(input_value):
-                try:
-                    return pd.datetime.utcfromtimestamp(float(input_value))
-                except (TypeError, ValueError):
-                    return pd.np.NaN
-
-            if len(returnList) > 0:
-                with BytesIO() as file_buffer:
-                    csv_writer = csv.writer(file_buffer, lineterminator='\n')
-                    csv_writer.writerows(returnList)
-                    file_buffer.seek(0)
-
-                    timestamp_cols = [x['name'] for x in query_schema if x['type'] == 'TIMESTAMP']
-
-                    if len(timestamp_cols) > 0:
-                        return_df = pd.read_csv(
-                            file_buffer,
-                            parse_dates=timestamp_cols,
-                            date_parser=lambda x: _convert_timestamp(x)
-                        )
-                    else:
-                        return_df = pd.read_csv(file_buffer)
-                return return_df
+            for schema_fields, rows in value_pages:
+                if query_schema is None:
+                    query_schema = schema_fields
+                    column_values = [[] for _ in query_schema]
+
+                for row in rows:
+                    for values, value in zip(column_values, row):
+                        values.append(value)
 
+            if query_schema is not None and len(column_values) > 0 and len(column_values[0]) > 0:
+                return _get_dataframe_from_columns(column_values, query_schema)
             else:
                 return None
 
         else:
-            raise TypeError('Data can only be exported as list or dataframe')
+            raise TypeError('Data can only be exported as list, dataframe or iterator')
 
-    def poll_job_status(self, response, print_details=True, sleep_time=1):
-        status_state = None
+    def _iterate_job_results(self, response, return_type, print_details, sleep_time, fetch_workers=None, cache_key=None):
+        response, first_page = self._wait_for_query_results(response, self._get_polling_policy(sleep_time), print_details)
 
+        value_pages = self._iterate_value_pages(response['jobReference'], first_page, fetch_workers)
+
+        # iterator results are meant to stay out of memory, so they're never written to the cache
+        if cache_key is not None and return_type != 'iterator':
+            value_pages = list(value_pages)
+            self._result_cache.set(cache_key, value_pages)
+
+        return self._format_query_results(value_pages, return_type)
+
+    def poll_job_status(self, response, print_details=True, sleep_time=None):
         project_id = response['jobReference']['projectId']
         job_id = response['jobReference']['jobId']
 
-        while not status_state == 'DONE':
+        # checks immediately, then backs off between checks until the job is done
+        poll_intervals = self._get_polling_policy(sleep_time).intervals()
+
+        while True:
             response = self._jobs.get(
                 jobId=job_id,
                 projectId=project_id
             ).execute(num_retries=self._max_retries)
 
             status_state = response['status']['state']
-            sleep(sleep_time)
+
+            if status_state == 'DONE':
+                break
+
+            sleep(next(poll_intervals))
+
+        return self._log_job_status(response, print_details)
+
+    def _log_job_status(self, response, print_details, query_results=None):
+        # raises on failed jobs, otherwise logs a summary of the completed job
+        # query_results takes a getQueryResults response of the job that is already at hand, for its totalRows
+        project_id = response['jobReference']['projectId']
+        job_id = response['jobReference']['jobId']
+
+        self._invalidate_job_destination(response)
 
         if 'errorResult' in response['status']:
             raise Error(response['status']['errorResult'])
@@ -684,14 +2036,15 @@ class BigqueryUtility:
         elif 'query' in response['statistics']:
             is_async = bool(response['configuration']['query']['allowLargeResults']) if 'allowLargeResults' in response['configuration']['query'] else False
 
-            query_response = self._jobs.getQueryResults(
-                    projectId=response['jobReference']['projectId'],
-                    jobId=response['jobReference']['jobId'],
-                    maxResults=0
-                ).execute(num_retries=self._max_retries)
+            if query_results is None:
+                query_results = self._jobs.getQueryResults(
+                        projectId=response['jobReference']['projectId'],
+                        jobId=response['jobReference']['jobId'],
+                        maxResults=0
+                    ).execute(num_retries=self._max_retries)
 
             file_size = humanize.naturalsize(int(response['statistics']['query']['totalBytesProcessed']))
-            row_count = int(query_response['totalRows'])
+            row_count = int(query_results['totalRows'])
 
             if is_async:
                 destination_table = '%s:%s:%s' % (
@@ -783,13 +2136,70 @@ class BigqueryUtility:
 
         return response
 
-    def check_status_from_responses(self, response_list, print_details=True, sleep_time=1):
+    def _get_job_statuses(self, job_references, batch_size=50):
+        """Fetches the job resources for job_references with one batched http request per batch_size jobs."""
+        job_dict = {}
+
+        def _batch_callback(request_id, response, exception):
+            if exception is None:
+                job_dict[request_id] = response
+
+            # server errors are left out and picked up again on the next round
+            elif exception.resp.status < 500:
+                raise exception
+
+        for batch_start in range(0, len(job_references), batch_size):
+            batch = self._service.new_batch_http_request(callback=_batch_callback)
+
+            for job_reference in job_references[batch_start:batch_start + batch_size]:
+                batch.add(
+                    self._jobs.get(
+                        projectId=job_reference['projectId'],
+                        jobId=job_reference['jobId']
+                    ),
+                    request_id='%s:%s' % (job_reference['projectId'], job_reference['jobId'])
+                )
+
+            batch.execute()
+
+        return job_dict
+
+    def iter_completed_jobs(self, response_list, print_details=True, sleep_time=None):
+        """Tracks many in-flight jobs at once and yields each job resource as soon as that job is done.
+
+        Every round checks all pending jobs in a single batched request, backing off between rounds
+        according to the polling policy. Failed jobs raise the same way as poll_job_status."""
+        pending_dict = OrderedDict(
+            ('%s:%s' % (response['jobReference']['projectId'], response['jobReference']['jobId']), response['jobReference'])
+            for response in response_list
+        )
+
+        poll_intervals = self._get_polling_policy(sleep_time).intervals()
+
+        while len(pending_dict) > 0:
+            job_dict = self._get_job_statuses(pending_dict.values())
+
+            for job_key, response in job_dict.items():
+                if response['status']['state'] == 'DONE':
+                    del pending_dict[job_key]
+                    yield self._log_job_status(response, print_details)
+
+            if len(pending_dict) > 0:
+                sleep(next(poll_intervals))
+
+    def check_status_from_responses(self, response_list, print_details=True, sleep_time=None):
         assert isinstance(response_list, (list, tuple, set))
-        return_list = []
-        for response in response_list:
-            return_list.append(self.poll_job_status(response, print_details, sleep_time))
+        response_list = list(response_list)
+
+        # jobs are polled together, results are still returned in the order they were passed in
+        completed_dict = {}
+        for response in self.iter_completed_jobs(response_list, print_details, sleep_time):
+            completed_dict[(response['jobReference']['projectId'], response['jobReference']['jobId'])] = response
 
-        return return_list
+        return [
+            completed_dict[(response['jobReference']['projectId'], response['jobReference']['jobId'])]
+            for response in response_list
+        ]
 
     def write_table(self,
                     project_id,
@@ -799,7 +2209,10 @@ class BigqueryUtility:
                     udfInlineCode=None,
                     print_details=True,
                     wait_finish=True,
-                    sleep_time=1):
+                    sleep_time=None,
+                    maximum_bytes=None):
+
+        self._check_maximum_bytes(project_id, query, udfInlineCode, maximum_bytes)
 
         # projectId, datasetId and tableId must be filled when writing to table
         write_project_id = write_data['projectId']
@@ -850,6 +2263,8 @@ class BigqueryUtility:
             body=request_body
         ).execute(num_retries=self._max_retries)
 
+        self._invalidate_job_destination(response)
+
         if wait_finish:
             return self.poll_job_status(response, print_details, sleep_time)
         else:
@@ -899,6 +2314,8 @@ class BigqueryUtility:
             else:
                 raise e
 
+        self._invalidate_table_info(write_project_id, write_dataset_id, write_table_id)
+
         logging_string = '[BigQuery] View Inserted (%s:%s:%s)' % (
                 write_project_id,
                 write_dataset_id,
@@ -921,7 +2338,7 @@ class BigqueryUtility:
                       writeDisposition='WRITE_TRUNCATE',
                       print_details=True,
                       wait_finish=True,
-                      sleep_time=1):
+                      sleep_time=None):
 
         assert source_format in ('CSV', 'NEWLINE_DELIMITED_JSON')
 
@@ -965,6 +2382,8 @@ class BigqueryUtility:
             body=request_body
         ).execute(num_retries=self._max_retries)
 
+        self._invalidate_job_destination(response)
+
         if wait_finish:
             return self.poll_job_status(response, print_details, sleep_time)
         else:
@@ -979,7 +2398,7 @@ class BigqueryUtility:
                       destinationFormat='CSV',
                       print_details=True,
                       wait_finish=True,
-                      sleep_time=1):
+                      sleep_time=None):
 
         request_body = {
             'jobReference': {
@@ -1011,16 +2430,7 @@ class BigqueryUtility:
         else:
             return response
 
-    def load_from_string(self,
-                        write_data,
-                        load_string,
-                        source_format='CSV',
-                        skipHeader=True,
-                        writeDisposition='WRITE_TRUNCATE',
-                        print_details=True,
-                        wait_finish=True,
-                        sleep_time=1):
-
+    def _get_load_request_body(self, write_data, source_format, skipHeader, writeDisposition):
         assert source_format in ('CSV', 'NEWLINE_DELIMITED_JSON')
 
         # projectId, datasetId, tableId, schemaFields must be filled for load jobs
@@ -1031,7 +2441,7 @@ class BigqueryUtility:
 
         quoted_newlines = 'false' if 'allowQuotedNewlines' not in write_data else write_data['allowQuotedNewlines']
 
-        request_body = {
+        return {
             'jobReference': {
                 'projectId': write_project_id,
                 'job_id': str(uuid.uuid4())
@@ -1055,26 +2465,108 @@ class BigqueryUtility:
             }
         }
 
+    def load_from_string(self,
+                        write_data,
+                        load_string,
+                        source_format='CSV',
+                        skipHeader=True,
+                        writeDisposition='WRITE_TRUNCATE',
+                        print_details=True,
+                        wait_finish=True,
+                        sleep_time=None):
+
+        request_body = self._get_load_request_body(write_data, source_format, skipHeader, writeDisposition)
+
         media_body = MediaInMemoryUpload(load_string, mimetype='application/octet-stream')
 
         response = self._jobs.insert(
                 body=request_body,
-                projectId=write_project_id,
+                projectId=write_data['projectId'],
                 media_body=media_body
         ).execute(num_retries=self._max_retries)
 
+        self._invalidate_job_destination(response)
+
+        if wait_finish:
+            return self.poll_job_status(response, print_details, sleep_time)
+        else:
+            return response
+
+    def load_from_file(self,
+                       write_data,
+                       source,
+                       source_format='CSV',
+                       skipHeader=True,
+                       writeDisposition='WRITE_TRUNCATE',
+                       print_details=True,
+                       wait_finish=True,
+                       sleep_time=None):
+        """Same as load_from_string, but source can be a file path, a file object or an iterator of byte chunks.
+
+        The data is sent as a resumable upload in chunks of self._CHUNKSIZE, so memory use is bounded by the
+        chunk size rather than the payload and a failed chunk is retried without restarting the upload."""
+
+        request_body = self._get_load_request_body(write_data, source_format, skipHeader, writeDisposition)
+
+        if isinstance(source, basestring):
+            media_body = MediaFileUpload(source, mimetype='application/octet-stream', chunksize=self._CHUNKSIZE, resumable=True)
+        else:
+            media_body = get_stream_media(source, 'application/octet-stream', self._CHUNKSIZE)
+
+        request = self._jobs.insert(
+                body=request_body,
+                projectId=write_data['projectId'],
+                media_body=media_body
+        )
+
+        response = execute_resumable(request, self._max_retries, self._RETRYABLE_ERRORS)
+
+        self._invalidate_job_destination(response)
+
         if wait_finish:
             return self.poll_job_status(response, print_details, sleep_time)
         else:
             return response
 
+    def load_from_dataframe(self,
+                            write_data,
+                            input_df,
+                            source_format='CSV',
+                            writeDisposition='WRITE_TRUNCATE',
+                            chunk_rows=100000,
+                            processes=None,
+                            print_details=True,
+                            wait_finish=True,
+                            sleep_time=None):
+        """Loads a dataframe as a single load job.
+
+        The dataframe is split into chunks of chunk_rows rows that are serialized to gzip compressed CSV or
+        NDJSON on a pool of processes (defaults to the cpu count), then streamed through load_from_file.
+        schemaFields in write_data defaults to get_schema_from_dataframe(input_df)."""
+        assert source_format in ('CSV', 'NEWLINE_DELIMITED_JSON')
+
+        write_data = dict(write_data)
+        if 'schemaFields' not in write_data:
+            write_data['schemaFields'] = get_schema_from_dataframe(input_df)
+
+        return self.load_from_file(
+            write_data,
+            _iterate_dataframe_chunks(input_df, source_format, chunk_rows, processes or cpu_count()),
+            source_format=source_format,
+            skipHeader=False,
+            writeDisposition=writeDisposition,
+            print_details=print_details,
+            wait_finish=wait_finish,
+            sleep_time=sleep_time
+        )
+
     def copy_table(self,
                     write_data,
                     copy_data,
                     writeDisposition='WRITE_TRUNCATE',
                     print_details=True,
                     wait_finish=True,
-                    sleep_time=1):
+                    sleep_time=None):
 
         # projectId, datasetId, tableId must be filled for write_data and copy_data
         required_keys = ['projectId', 'datasetId', 'tableId']
@@ -1108,6 +2600,8 @@ class BigqueryUtility:
             body=request_body
         ).execute(num_retries=self._max_retries)
 
+        self._invalidate_job_destination(response)
+
         if wait_finish:
             return self.poll_job_status(response, print_details, sleep_time)
         else:
@@ -1176,6 +2670,8 @@ class BigqueryUtility:
             else:
                 raise e
 
+        self._invalidate_table_info(write_project_id, write_dataset_id, write_table_id)
+
         logging_string = '[BigQuery] Federated Table Inserted (%s:%s:%s) from %s' % (
                 write_project_id,
                 write_dataset_id,
@@ -1234,6 +2730,10 @@ class BigqueryUtility:
             body=request_body
         ).execute(num_retries=self._max_retries)
 
+        # patch returns the full table resource
+        if self._table_cache is not None:
+            self._table_cache.set((project_id, dataset_id, table_id), response)
+
         logging_string = '[BigQuery] Table Patched (%s:%s:%s)' % (
                 project_id,
                 dataset_id,
@@ -1298,6 +2798,8 @@ class BigqueryUtility:
             else:
                 raise e
 
+        self._invalidate_table_info(write_project_id, write_dataset_id, write_table_id)
+
         logging_string = '[BigQuery] Google Sheets Table Inserted (%s:%s:%s) from %s' % (
                 write_project_id,
                 write_dataset_id,
@@ -1,27 +1,94 @@
 import os
+import io
+import zlib
+import mimetypes
 import humanize
-from time import sleep
 from datetime import datetime
 from pytz import UTC
 from urllib2 import quote
 from httplib2 import HttpLib2Error
-import random
+import base64
+import hashlib
+import uuid
+from multiprocessing.pool import ThreadPool
 
 from oauth2client.client import GoogleCredentials, ApplicationDefaultCredentialsError, flow_from_clientsecrets, UnknownClientSecretsFlowError
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, MediaIoBaseDownload
+
+from misc_utility import ThreadLocalHttp, get_stream_media, handle_progressless_iter, execute_resumable
+
+
+class _FileSlice:
+    # read only file object over length bytes of a file starting at offset, for uploading part of a file
+    def __init__(self, read_path, offset, length):
+        self._file = open(read_path, 'rb')
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self._length
+
+        self._position = max(0, min(position, self._length))
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if size < 0 or size > self._length - self._position:
+            size = self._length - self._position
+
+        self._file.seek(self._offset + self._position)
+        data = self._file.read(size)
+        self._position += len(data)
+
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class _ChunkReader(io.RawIOBase):
+    # raw file object over an iterator of byte chunks, wrapped in io.BufferedReader for read and readline
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+
+        length = min(len(b), len(self._buffer))
+        b[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+
+        return length
 
 
 class GcsUtility:
     def __init__(self, logger=None, authentication_type='Default Credentials', credential_file_path=None, user_name=None, client_secret_path=None, max_retries=3):
+        OAUTH_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
 
         if authentication_type == 'Default Credentials':
             # try building from application default
             try:
                 credentials = GoogleCredentials.get_application_default()
-                service = build('storage', 'v1', credentials=credentials)
+                if credentials.create_scoped_required():
+                    credentials = credentials.create_scoped(OAUTH_SCOPE)
+
+                service = build('storage', 'v1', http=ThreadLocalHttp(credentials))
             except ApplicationDefaultCredentialsError as e:
                 print 'Application Default Credentials unavailable. ' \
                       'To set up Default Credentials, download gcloud from https://cloud.google.com/sdk/gcloud/ ' \
@@ -29,11 +96,8 @@ class GcsUtility:
                 raise e
 
         elif authentication_type == 'Stored Credentials':
-            import httplib2
             from oauth2client.contrib import multistore_file
 
-            OAUTH_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
-
             assert user_name is not None and credential_file_path is not None
             storage = multistore_file.get_credential_storage(
                 filename=credential_file_path,
@@ -61,11 +125,8 @@ class GcsUtility:
                 FLOW = flow_from_clientsecrets(client_secret_path, scope=OAUTH_SCOPE)
                 credentials = run_flow(FLOW, storage, flags)
 
-            # Create an httplib2.Http object and authorize it with your credentials
-            http = httplib2.Http()
-            http = credentials.authorize(http)
-
-            service = build('storage', 'v1', http=http)
+            # authorized httplib2.Http objects are created per thread from the credentials
+            service = build('storage', 'v1', http=ThreadLocalHttp(credentials))
         else:
             raise TypeError('Authentication types available are "Default Credentials" and "Stored Credentials"')
 
@@ -101,7 +162,7 @@ class GcsUtility:
         else:
             return buckets_list
 
-        if buckets_count > max_results:
+        if max_results is not None and buckets_count > max_results:
             buckets_list = buckets_list[:max_results]
             return buckets_list
 
@@ -119,7 +180,7 @@ class GcsUtility:
                 buckets_list += response['items']
                 buckets_count += len(response['items'])
 
-            if buckets_count > max_results:
+            if max_results is not None and buckets_count > max_results:
                 buckets_list = buckets_list[:max_results]
                 break
 
@@ -141,7 +202,7 @@ class GcsUtility:
         else:
             return objects_list
 
-        if objects_count > max_results:
+        if max_results is not None and objects_count > max_results:
             objects_list = objects_list[:max_results]
             return objects_list
 
@@ -160,7 +221,7 @@ class GcsUtility:
                 objects_list += response['items']
                 objects_count += len(response['items'])
 
-            if objects_count > max_results:
+            if max_results is not None and objects_count > max_results:
                 objects_list = objects_list[:max_results]
                 break
 
@@ -184,32 +245,37 @@ class GcsUtility:
         return response
 
     def _handle_progressless_iter(self, error, progressless_iters):
-        if progressless_iters > self._max_retries:
-            print 'Failed to make progress for too many consecutive iterations.'
-            raise error
+        handle_progressless_iter(error, progressless_iters, self._max_retries)
 
-        sleeptime = random.random() * (2**progressless_iters)
-        print ('Caught exception (%s). Sleeping for %s seconds before retry #%d.'
-                % (str(error), sleeptime, progressless_iters))
-        sleep(sleeptime)
-
-    def download_object(self, bucket_name, object_name, write_path, subfolders=None, print_details=True):
-        write_file = file(write_path, 'wb')
-
-        request = self._objects.get_media(
+    def _get_media_request(self, bucket_name, object_name, subfolders, meta_data):
+        # pinned to the generation in meta_data, so ranged requests can't mix versions of an object being overwritten
+        return self._objects.get_media(
             bucket=bucket_name,
-            object=self._parse_object_name(object_name, subfolders)
+            object=self._parse_object_name(object_name, subfolders),
+            generation=meta_data['generation']
         )
 
-        media = MediaIoBaseDownload(write_file, request, chunksize=self._CHUNKSIZE)
-
+    def _iter_object_range(self, request, range_start, range_end):
+        # yields bytes range_start to range_end in chunks of ranged requests, retrying each chunk
+        progress = range_start
         progressless_iters = 0
-        done = False
 
-        while not done:
+        while progress <= range_end:
             error = None
             try:
-                progress, done = media.next_chunk()
+                headers = dict(request.headers)
+                headers['range'] = 'bytes=%d-%d' % (progress, min(progress + self._CHUNKSIZE, range_end + 1) - 1)
+
+                resp, content = request.http.request(request.uri, headers=headers)
+
+                # a 200 means the range was ignored and the object is sent from byte 0, so it's only valid for a range from 0
+                if resp.status != 206 and not (resp.status == 200 and progress == 0):
+                    raise HttpError(resp, content, uri=request.uri)
+
+                content = content[:range_end - progress + 1]
+
+                if len(content) == 0:
+                    raise IOError('Empty response for bytes %d-%d' % (progress, range_end))
             except HttpError, err:
                 error = err
                 if err.resp.status < 500:
@@ -222,8 +288,122 @@ class GcsUtility:
                 self._handle_progressless_iter(error, progressless_iters)
             else:
                 progressless_iters = 0
+                progress += len(content)
+                yield content
+
+    def _download_slice(self, request, write_path, slice_start, slice_end):
+        # writes bytes slice_start to slice_end at their offset in the preallocated file
+        with open(write_path, 'r+b') as write_file:
+            write_file.seek(slice_start)
+
+            for content in self._iter_object_range(request, slice_start, slice_end):
+                write_file.write(content)
+
+    def iter_object_chunks(self, bucket_name, object_name, subfolders=None, decompress=False):
+        """Yields the content of an object in chunks of up to self._CHUNKSIZE bytes, without a local file.
 
+        With decompress, gzip content (including several concatenated gzip members, as in
+        BigQuery exports) is decompressed as it streams."""
         meta_data = self.get_object_metadata(bucket_name, object_name, subfolders)
+        object_size = int(meta_data['size'])
+
+        if object_size == 0:
+            return
+
+        chunks = self._iter_object_range(self._get_media_request(bucket_name, object_name, subfolders, meta_data), 0, object_size - 1)
+
+        if not decompress:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+
+                # bytes after the end of a gzip member start the next member
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def iter_object_lines(self, bucket_name, object_name, subfolders=None, decompress=False):
+        """Yields the lines of an object, with their line endings, e.g. for csv.reader or json lines."""
+        for line in self.open_object(bucket_name, object_name, subfolders, decompress):
+            yield line
+
+    def open_object(self, bucket_name, object_name, subfolders=None, decompress=False):
+        """Returns a read only file object streaming the object, e.g. for pd.read_csv. See iter_object_chunks."""
+        return io.BufferedReader(_ChunkReader(self.iter_object_chunks(bucket_name, object_name, subfolders, decompress)), self._CHUNKSIZE)
+
+    def download_object(self, bucket_name, object_name, write_path, subfolders=None, print_details=True, parallel_slices=1):
+        """Downloads an object to write_path.
+
+        With parallel_slices > 1, objects larger than parallel_slices chunks are split into that many byte ranges
+        which are downloaded concurrently into a preallocated file, each slice retrying on its own."""
+        if parallel_slices > 1:
+            meta_data = self.get_object_metadata(bucket_name, object_name, subfolders)
+            object_size = int(meta_data['size'])
+
+        if parallel_slices > 1 and object_size > parallel_slices * self._CHUNKSIZE:
+            request = self._get_media_request(bucket_name, object_name, subfolders, meta_data)
+
+            with open(write_path, 'wb') as write_file:
+                write_file.truncate(object_size)
+
+            slice_size = -(-object_size // parallel_slices)
+            slice_ranges = [
+                (slice_start, min(slice_start + slice_size, object_size) - 1)
+                for slice_start in range(0, object_size, slice_size)
+            ]
+
+            pool = ThreadPool(len(slice_ranges))
+            try:
+                pool.map(lambda slice_range: self._download_slice(request, write_path, *slice_range), slice_ranges)
+            finally:
+                pool.close()
+
+        else:
+            write_file = file(write_path, 'wb')
+
+            request = self._objects.get_media(
+                bucket=bucket_name,
+                object=self._parse_object_name(object_name, subfolders)
+            )
+
+            media = MediaIoBaseDownload(write_file, request, chunksize=self._CHUNKSIZE)
+
+            progressless_iters = 0
+            done = False
+
+            while not done:
+                error = None
+                try:
+                    progress, done = media.next_chunk()
+                except HttpError, err:
+                    error = err
+                    if err.resp.status < 500:
+                        raise
+                except self._RETRYABLE_ERRORS, err:
+                    error = err
+
+                if error:
+                    progressless_iters += 1
+                    self._handle_progressless_iter(error, progressless_iters)
+                else:
+                    progressless_iters = 0
+
+            write_file.close()
+
+            meta_data = self.get_object_metadata(bucket_name, object_name, subfolders)
+
         file_size = humanize.naturalsize(int(meta_data['size']))
 
         logging_string = '[GCS] Downloaded gs://%s/%s (%s)' % (meta_data['bucket'], meta_data['name'], file_size)
@@ -234,39 +414,116 @@ class GcsUtility:
         if self._logger is not None:
             self._logger.info(logging_string)
 
-    def upload_object(self, bucket_name, object_name, read_path, subfolders=None, print_details=True):
+    def _upload_composite(self, bucket_name, object_name, read_path, mimetype, parallel_parts):
+        # uploads byte ranges of the file as temporary objects in parallel, then composes them into object_name
+        file_size = os.path.getsize(read_path)
+        part_size = -(-file_size // parallel_parts)
+        part_prefix = '%s.part-%s' % (object_name, uuid.uuid4())
+
+        part_ranges = [
+            ('%s-%02d' % (part_prefix, part_index), part_start, min(part_size, file_size - part_start))
+            for part_index, part_start in enumerate(range(0, file_size, part_size))
+        ]
+
+        def _upload_part(part_range):
+            part_name, part_start, part_length = part_range
+            part_file = _FileSlice(read_path, part_start, part_length)
+
+            try:
+                media = MediaIoBaseUpload(part_file, mimetype, chunksize=self._CHUNKSIZE, resumable=True)
+                return execute_resumable(self._objects.insert(bucket=bucket_name, name=part_name, media_body=media), self._max_retries, self._RETRYABLE_ERRORS)
+            finally:
+                part_file.close()
+
+        pool = ThreadPool(len(part_ranges))
+        try:
+            pool.map(_upload_part, part_ranges)
+
+            return self._objects.compose(
+                destinationBucket=bucket_name,
+                destinationObject=object_name,
+                body={
+                    'sourceObjects': [{'name': part_name} for part_name, part_start, part_length in part_ranges],
+                    'destination': {'contentType': mimetype}
+                }
+            ).execute(num_retries=self._max_retries)
+        finally:
+            # parts are removed whether or not the upload succeeded, including parts that were never created
+            def _delete_part(part_range):
+                try:
+                    self._objects.delete(bucket=bucket_name, object=part_range[0]).execute(num_retries=self._max_retries)
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+
+            pool.map(_delete_part, part_ranges)
+            pool.close()
+
+    def upload_object(self, bucket_name, object_name, read_path, subfolders=None, print_details=True, parallel_parts=1):
+        """Uploads the file at read_path.
+
+        With parallel_parts > 1 (up to 32), files larger than parallel_parts chunks are split into that many parts
+        which are uploaded concurrently and combined with objects.compose. Composite objects have a crc32c
+        but no md5 hash."""
+        assert 1 <= parallel_parts <= 32, 'objects.compose takes up to 32 parts'
+
         process_start_time = datetime.now(UTC)
+        object_name = self._parse_object_name(object_name, subfolders)
 
         media = MediaFileUpload(read_path, chunksize=self._CHUNKSIZE, resumable=True)
 
         if not media.mimetype():
-            media = MediaFileUpload(read_path, self._DEFAULT_MIMETYPE, resumable=True)
-        
+            media = MediaFileUpload(read_path, self._DEFAULT_MIMETYPE, chunksize=self._CHUNKSIZE, resumable=True)
+
+        if parallel_parts > 1 and media.size() > parallel_parts * self._CHUNKSIZE:
+            response = self._upload_composite(bucket_name, object_name, read_path, media.mimetype(), parallel_parts)
+        else:
+            request = self._objects.insert(
+                bucket=bucket_name,
+                name=object_name,
+                media_body=media
+            )
+
+            response = execute_resumable(request, self._max_retries, self._RETRYABLE_ERRORS)
+
+        self._log_upload(response, process_start_time, print_details)
+
+        return response
+
+    def upload_object_from_stream(self, bucket_name, object_name, source, subfolders=None, mimetype=None, print_details=True):
+        """Uploads from a file object or an iterator of byte chunks instead of a file on disk.
+
+        The data is sent as a resumable upload in chunks of self._CHUNKSIZE, and its length doesn't need to be
+        known upfront, so pipes, sockets and generators are streamed without a temporary file.
+        mimetype is guessed from object_name if not given."""
+        process_start_time = datetime.now(UTC)
+        object_name = self._parse_object_name(object_name, subfolders)
+
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(object_name)[0] or self._DEFAULT_MIMETYPE
+
+        media = get_stream_media(source, mimetype, self._CHUNKSIZE)
+
+        # resumable uploads can't finalise zero bytes, so an empty source is sent as a simple upload
+        if media.size() == 0:
+            media = MediaIoBaseUpload(io.BytesIO(b''), mimetype, resumable=False)
+
         request = self._objects.insert(
             bucket=bucket_name,
-            name=self._parse_object_name(object_name, subfolders),
+            name=object_name,
             media_body=media
         )
 
-        progressless_iters = 0
-        response = None
-        while response is None:
-            error = None
-            try:
-                progress, response = request.next_chunk()
-            except HttpError, err:
-                error = err
-                if err.resp.status < 500:
-                    raise
-            except self._RETRYABLE_ERRORS, err:
-                error = err
+        if media.resumable():
+            response = execute_resumable(request, self._max_retries, self._RETRYABLE_ERRORS)
+        else:
+            response = request.execute(num_retries=self._max_retries)
 
-            if error:
-                progressless_iters += 1
-                self._handle_progressless_iter(error, progressless_iters)
-            else:
-                progressless_iters = 0
+        self._log_upload(response, process_start_time, print_details)
 
+        return response
+
+    def _log_upload(self, response, process_start_time, print_details):
         file_size = humanize.naturalsize(int(response['size']))
         updated_at = UTC.localize(datetime.strptime(response['updated'], '%Y-%m-%dT%H:%M:%S.%fZ'))
         time_diff = (updated_at - process_start_time).seconds if updated_at > process_start_time else 0
@@ -289,8 +546,6 @@ class GcsUtility:
         if self._logger is not None:
             self._logger.info(logging_string)
 
-        return response
-
     def delete_object(self, bucket_name, object_name, subfolders=None, print_details=True):
         response = None
         while response is None:
@@ -311,3 +566,148 @@ class GcsUtility:
             self._logger.info(logging_string)
 
         return response
+
+    def _get_local_hashes(self, read_path, hash_types):
+        # base64 digests in the same form as the md5Hash and crc32c object metadata
+        md5_hash = hashlib.md5() if 'md5Hash' in hash_types else None
+        crc32c_hash = None
+
+        if 'crc32c' in hash_types:
+            try:
+                import crcmod.predefined
+                crc32c_hash = crcmod.predefined.Crc('crc-32c')
+            except ImportError:
+                pass
+
+        with open(read_path, 'rb') as read_file:
+            for data in iter(lambda: read_file.read(self._CHUNKSIZE), b''):
+                if md5_hash is not None:
+                    md5_hash.update(data)
+                if crc32c_hash is not None:
+                    crc32c_hash.update(data)
+
+        local_hashes = {}
+        if md5_hash is not None:
+            local_hashes['md5Hash'] = base64.b64encode(md5_hash.digest())
+        if crc32c_hash is not None:
+            local_hashes['crc32c'] = base64.b64encode(crc32c_hash.digest())
+
+        return local_hashes
+
+    def _is_unchanged(self, read_path, object_meta):
+        # same size and a matching md5, or crc32c for composite objects which have no md5
+        if os.path.getsize(read_path) != int(object_meta['size']):
+            return False
+
+        hash_types = ['md5Hash'] if 'md5Hash' in object_meta else ['crc32c']
+        local_hashes = self._get_local_hashes(read_path, hash_types)
+
+        # crcmod is needed to check crc32c, without it files are transferred anyway
+        return any(local_hashes.get(hash_type) == object_meta.get(hash_type) for hash_type in local_hashes)
+
+    def sync(self, local_dir, bucket_name, prefix='', direction='upload', delete_extra=False, max_workers=16, print_details=True, allow_empty_source=False):
+        """Syncs the files under local_dir with the objects under prefix, similar to rsync.
+
+        direction is upload (local_dir to gs://bucket_name/prefix) or download. Both sides are listed
+        in parallel, and files with the same size and md5 (or crc32c with crcmod installed) are skipped.
+        The remaining files are transferred on max_workers threads. With delete_extra, files on the
+        destination side that aren't on the source side are deleted. An empty source side (e.g. a mistyped
+        prefix) raises instead of deleting the whole destination, unless allow_empty_source is set.
+        Returns a dict of the transferred and deleted relative paths and the unchanged count."""
+        assert direction in ('upload', 'download'), 'direction should be upload or download'
+
+        # a missing source would otherwise look empty, and delete_extra would remove everything under prefix
+        if direction == 'upload' and not os.path.isdir(local_dir):
+            raise IOError('%s is not a directory' % local_dir)
+
+        object_prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+        def _list_local_files():
+            local_files = {}
+
+            if os.path.isdir(local_dir):
+                for dir_path, dir_names, file_names in os.walk(local_dir):
+                    for file_name in file_names:
+                        file_path = os.path.join(dir_path, file_name)
+                        local_files[os.path.relpath(file_path, local_dir).replace(os.sep, '/')] = file_path
+
+            return local_files
+
+        def _list_remote_objects():
+            return dict(
+                (item['name'][len(object_prefix):], item)
+                for item in self.list_objects(bucket_name, search_prefix=object_prefix or None)
+                if not item['name'].endswith('/')
+            )
+
+        pool = ThreadPool(max_workers)
+        try:
+            local_result = pool.apply_async(_list_local_files)
+            remote_result = pool.apply_async(_list_remote_objects)
+            local_files = local_result.get()
+            remote_objects = remote_result.get()
+
+            source_paths, destination_paths = (local_files, remote_objects) if direction == 'upload' else (remote_objects, local_files)
+
+            if delete_extra and len(source_paths) == 0 and len(destination_paths) > 0 and not allow_empty_source:
+                raise ValueError('Refusing to delete %d files as %s is empty, pass allow_empty_source=True to allow this' % (
+                    len(destination_paths),
+                    local_dir if direction == 'upload' else 'gs://%s/%s' % (bucket_name, object_prefix)
+                ))
+
+            # hashes are only computed for files present on both sides, in parallel
+            common_paths = sorted(set(source_paths) & set(destination_paths))
+            unchanged_flags = pool.map(
+                lambda relative_path: self._is_unchanged(local_files[relative_path], remote_objects[relative_path]),
+                common_paths
+            )
+            unchanged_paths = set(relative_path for relative_path, is_unchanged in zip(common_paths, unchanged_flags) if is_unchanged)
+
+            transfer_paths = sorted(set(source_paths) - unchanged_paths)
+            delete_paths = sorted(set(destination_paths) - set(source_paths)) if delete_extra else []
+
+            def _transfer(relative_path):
+                if direction == 'upload':
+                    self.upload_object(bucket_name, object_prefix + relative_path, local_files[relative_path], print_details=print_details)
+                else:
+                    write_path = os.path.join(local_dir, *relative_path.split('/'))
+                    try:
+                        os.makedirs(os.path.dirname(write_path))
+                    except OSError:
+                        if not os.path.isdir(os.path.dirname(write_path)):
+                            raise
+
+                    self.download_object(bucket_name, object_prefix + relative_path, write_path, print_details=print_details)
+
+            def _delete(relative_path):
+                if direction == 'upload':
+                    self.delete_object(bucket_name, object_prefix + relative_path, print_details=print_details)
+                else:
+                    os.remove(local_files[relative_path])
+
+            pool.map(_transfer, transfer_paths)
+            pool.map(_delete, delete_paths)
+        finally:
+            pool.close()
+
+        logging_string = '[GCS] Synced %s %s gs://%s/%s with %d transferred, %d deleted and %d unchanged' % (
+            local_dir,
+            'to' if direction == 'upload' else 'from',
+            bucket_name,
+            object_prefix,
+            len(transfer_paths),
+            len(delete_paths),
+            len(unchanged_paths)
+        )
+
+        if print_details:
+            print '\t' + logging_string
+
+        if self._logger is not None:
+            self._logger.info(logging_string)
+
+        return {
+            'transferred': transfer_paths,
+            'deleted': delete_paths,
+            'unchanged': len(unchanged_paths)
+        }
@@ -4,6 +4,14 @@ from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
 import logging
 from StringIO import StringIO
+import threading
+import os
+import random
+from time import sleep
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaUpload, MediaIoBaseUpload
 
 
 class StringLogger:
@@ -48,6 +56,156 @@ class StringLogger:
         self._log_capture_string.close()
 
 
+class ThreadLocalHttp:
+    """Stands in for the authorized httplib2.Http passed to googleapiclient's build.
+
+    httplib2 connections can't be shared across threads, so each thread lazily gets its own
+    authorized Http. This lets a single service object be used from worker threads.
+    request_count counts the http requests made across all threads."""
+
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._local = threading.local()
+        self._count_lock = threading.Lock()
+        self.request_count = 0
+
+        # googleapiclient looks for request.credentials to refresh and apply tokens, e.g. in batch requests
+        def request(*args, **kwargs):
+            if not hasattr(self._local, 'http'):
+                http = httplib2.Http()
+
+                # httplib2 0.18+ follows 308 redirects, which resumable uploads use for "Resume Incomplete"
+                if hasattr(http, 'redirect_codes'):
+                    http.redirect_codes = set(http.redirect_codes) - set([308])
+
+                self._local.http = self._credentials.authorize(http)
+
+            with self._count_lock:
+                self.request_count += 1
+
+            return self._local.http.request(*args, **kwargs)
+
+        request.credentials = credentials
+        self.request = request
+
+
+class IterableMediaUpload(MediaUpload):
+    """Resumable media upload from an iterator of byte chunks or a non-seekable file object.
+
+    The total length doesn't need to be known upfront. Bytes already acknowledged by the server are
+    dropped as the upload progresses, so at most about two chunks are held in memory."""
+
+    def __init__(self, source, mimetype='application/octet-stream', chunksize=2 * 1024 * 1024):
+        if hasattr(source, 'read'):
+            fileobj = source
+            source = iter(lambda: fileobj.read(chunksize), b'')
+
+        self._iterator = iter(source)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+
+        # stream offset of the first buffered byte, everything before it has been acknowledged
+        self._buffer = b''
+        self._buffer_offset = 0
+        self._exhausted = False
+
+    def _fill_buffer(self, end_offset):
+        pieces = [self._buffer]
+        buffered_length = len(self._buffer)
+
+        while not self._exhausted and self._buffer_offset + buffered_length < end_offset:
+            try:
+                piece = next(self._iterator)
+            except StopIteration:
+                self._exhausted = True
+                break
+
+            pieces.append(piece)
+            buffered_length += len(piece)
+
+        self._buffer = b''.join(pieces)
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def size(self):
+        # reads a byte past the next chunk, so a source ending exactly on a chunk boundary
+        # is finalised with its total size instead of an empty trailing request
+        self._fill_buffer(self._buffer_offset + 2 * self._chunksize + 1)
+
+        if self._exhausted:
+            return self._buffer_offset + len(self._buffer)
+        else:
+            return None
+
+    def getbytes(self, begin, length):
+        assert begin >= self._buffer_offset, 'Bytes before %d are no longer buffered' % self._buffer_offset
+
+        self._buffer = self._buffer[begin - self._buffer_offset:]
+        self._buffer_offset = begin
+
+        self._fill_buffer(begin + length)
+        return self._buffer[:length]
+
+    def to_json(self):
+        raise NotImplementedError('IterableMediaUpload can not be serialized')
+
+
+def get_stream_media(source, mimetype, chunksize):
+    """Returns resumable media for a file object or an iterator of byte chunks."""
+    try:
+        # seekable file objects report their size, pipes and sockets fail here and are streamed instead
+        source.seek(0, os.SEEK_END)
+        source.seek(0)
+        return MediaIoBaseUpload(source, mimetype, chunksize=chunksize, resumable=True)
+    except (AttributeError, IOError):
+        return IterableMediaUpload(source, mimetype, chunksize=chunksize)
+
+
+def handle_progressless_iter(error, progressless_iters, max_retries):
+    if progressless_iters > max_retries:
+        print 'Failed to make progress for too many consecutive iterations.'
+        raise error
+
+    sleeptime = random.random() * (2**progressless_iters)
+    print ('Caught exception (%s). Sleeping for %s seconds before retry #%d.'
+            % (str(error), sleeptime, progressless_iters))
+    sleep(sleeptime)
+
+
+def execute_resumable(request, max_retries, retryable_errors):
+    """Sends a resumable upload chunk by chunk, retrying a failed chunk without restarting the upload."""
+    progressless_iters = 0
+    response = None
+    while response is None:
+        error = None
+        try:
+            progress, response = request.next_chunk()
+        except HttpError, err:
+            error = err
+            if err.resp.status < 500:
+                raise
+        except retryable_errors, err:
+            error = err
+
+        if error:
+            progressless_iters += 1
+            handle_progressless_iter(error, progressless_iters, max_retries)
+        else:
+            progressless_iters = 0
+
+    return response
+
+
 def send_mail(
             send_to,
             subject,